@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+"""
+persistent cache of parsed gtf files; the sample parsed from a gtf file
+  is saved to a cache directory, which may be shared by concurrent jobs,
+  keyed on the label, path, size, mtime and content hash of the file, so
+  merging the same sample again loads it instead of parsing text; the
+  least recently used entries are evicted to keep the cache within
+  params.cache_size MB; the cache is only an optimization, so failures
+  to write to it are reported as warnings and the merge goes on; an
+  entry is a line of JSON header followed by the raw buffers of the
+  sample arrays, so loading one, unlike unpickling, can not run code
+  planted in a shared cache directory
+"""
+
+## system:
+import array
+import hashlib
+import json
+import os
+import socket
+import sys
+import time
+
+## version of cached sample layout; bump when parse_gtf_file() changes:
+CACHE_VERSION = 4
+CHUNK_SIZE = 1 << 20
+## sample keys saved in the JSON header, besides array layout:
+JSON_KEYS = ('chrs', 'old_ids', 'old_genes', 'n_bytes')
+SUFFIX = '.sample'
+TMP_SUFFIX = '.tmp'
+## temporary files older than this (s) were left by jobs that died:
+TMP_MAX_AGE = 3600
+
+
+def content_hash(path):
+    '''
+    returns hex digest of blake2b hash of contents of path
+    '''
+
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as fh:
+        while True:
+            chunk = fh.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def cache_file(label, gtf, params):
+    '''
+    returns path of cache entry for label and gtf
+    '''
+
+    stat = os.stat(gtf)
+    key = '\0'.join(
+        str(val) for val in (
+            CACHE_VERSION,
+            label,
+            os.path.abspath(gtf),
+            stat.st_size,
+            stat.st_mtime_ns,
+            content_hash(gtf),
+        )
+    )
+    name = hashlib.blake2b(key.encode(), digest_size=20).hexdigest()
+
+    return os.path.join(params.cache_dir, f"{name}{SUFFIX}")
+
+
+def write_sample(sample, fh):
+    '''
+    writes sample to binary fh as a line of JSON header, w/ JSON_KEYS of
+      sample and (key, typecode, itemsize, length) of each array.array 
+      of sample, followed by the raw buffers of those arrays
+    '''
+
+    keys = [key for key, value in sample.items() if isinstance(value, array.array)]
+    header = {
+        'version': CACHE_VERSION,
+        'byteorder': sys.byteorder,
+        'arrays': [
+            [key, sample[key].typecode, sample[key].itemsize, len(sample[key])]
+            for key in keys
+        ],
+        **{key: sample[key] for key in JSON_KEYS},
+    }
+
+    ## ASCII, w/ newlines escaped:
+    fh.write(json.dumps(header).encode() + b'\n')
+    for key in keys:
+        sample[key].tofile(fh)
+
+
+def read_sample(fh):
+    '''
+    returns sample read from binary fh as written by write_sample(), w/
+      'chr2idx' rebuilt from 'chrs'; raises Exception if fh does not 
+      hold such a sample for this version and platform
+    '''
+
+    header = json.loads(fh.readline())
+
+    if header['version'] != CACHE_VERSION or header['byteorder'] != sys.byteorder:
+        raise Exception("cache entry from another version or platform")
+
+    sample = {key: header[key] for key in JSON_KEYS}
+    sample['chr2idx'] = {chr_id.encode(): idx for idx, chr_id in enumerate(sample['chrs'])}
+
+    for key, typecode, itemsize, length in header['arrays']:
+        values = array.array(typecode)
+        if values.itemsize != itemsize:
+            raise Exception(f"item size mismatch for {key}")
+        values.fromfile(fh, length)
+        sample[key] = values
+
+    if fh.read(1):
+        raise Exception("trailing data in cache entry")
+
+    return sample
+
+
+def load_sample(file_in):
+    '''
+    entry point
+    returns sample saved to cache entry file_in, or None if there is no
+      such entry or it can not be read, so it is parsed and saved again;
+      marks entry as recently used
+    '''
+
+    try:
+        with open(file_in, 'rb') as fh:
+            sample = read_sample(fh)
+    except Exception:
+        return None
+
+    try:
+        os.utime(file_in)
+    except FileNotFoundError:
+        pass                       ## evicted by another job meanwhile
+
+    return sample
+
+
+def warn(message):
+    sys.stderr.write(f"WARNING: {message}\n")
+
+
+def remove_file(path):
+    '''
+    removes path; returns False, w/ a warning, if path exists but can
+      not be removed
+    '''
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        warn(f"remove_file: for {path}: {e}")
+        return False
+
+    return True
+
+
+def save_sample(sample, file_out, params):
+    '''
+    entry point
+    writes sample to cache entry file_out, replacing it atomically, then
+      evicts least recently used entries until the cache is within
+      params.cache_size MB; if writing fails, e.g. for a full disk or
+      missing permissions, warns and leaves sample uncached
+    '''
+
+    ## temporary name unique across jobs sharing the cache directory:
+    file_tmp = f"{file_out}.{socket.gethostname()}.{os.getpid()}{TMP_SUFFIX}"
+
+    try:
+        os.makedirs(params.cache_dir, exist_ok=True)
+        with open(file_tmp, 'wb') as fh:
+            write_sample(sample, fh)
+        os.replace(file_tmp, file_out)
+    except Exception as e:
+        warn(f"save_sample: for file_out {file_out}: {e}; not cached")
+        if os.path.exists(file_tmp):
+            remove_file(file_tmp)
+        return
+
+    evict(params)
+
+
+def evict(params):
+    '''
+    removes least recently used entries from params.cache_dir until the
+      total size of entries is at most params.cache_size MB; temporary
+      files of writes in progress count toward the size, and are removed
+      once older than TMP_MAX_AGE; files removed by other jobs meanwhile
+      are skipped, and failures are only warned about
+    '''
+
+    entries = []
+    n_bytes = 0
+    time_tmp = time.time() - TMP_MAX_AGE
+
+    try:
+        for entry in os.scandir(params.cache_dir):
+            ## also matches '.sample.pkl' entries of earlier versions, so
+            ##   they are evicted in turn:
+            if SUFFIX not in entry.name:
+                continue
+            is_tmp = entry.name.endswith(TMP_SUFFIX)
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if is_tmp and stat.st_mtime < time_tmp and remove_file(entry.path):
+                continue                     ## left by a job that died
+            n_bytes += stat.st_size
+            if not is_tmp:
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        entries.sort()
+        max_bytes = params.cache_size * 1000000
+
+        for mtime_ns, size, path in entries:
+            if n_bytes <= max_bytes:
+                break
+            if remove_file(path):
+                n_bytes -= size
+    except Exception as e:
+        warn(f"evict: for cache_dir {params.cache_dir}: {e}")
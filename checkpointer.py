@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""
+stage checkpoints; dat is saved after chosen stages of mergegtfs.py,
+  so a later run can resume from the following stage, e.g. to redo
+  overlaps and naming w/ new --p_exon_overlap, --p_exons_overlap
+"""
+
+## system:
+import os
+import pickle
+
+
+## stages of mergegtfs.py, in order:
+STAGES = (
+    'ingest',
+    'fusions',
+    'tranges',
+    'xref',
+    'resolve',
+    'overlaps',
+    'naming',
+    'output',
+)
+
+## parameters results of each stage depend on:
+STAGE_PARAMS = {
+    'ingest': ('sort_exons', 'rev_neg_exons'),
+    'fusions': ('max_intron_length',),
+    'tranges': (),
+    'xref': ('tol_sj', 'tol_tss', 'tol_tts'),
+    'resolve': (),
+    'overlaps': ('p_exon_overlap', 'p_exons_overlap'),
+    'naming': ('gene_prefix',),
+    'output': (),
+}
+
+
+def checkpoint_file(params, stage):
+    return os.path.join(params.checkpoint_dir, f"{stage}.pkl")
+
+
+def save_checkpoint(dat, id2gtf, params, stage):
+    '''
+    entry point
+    writes dat, id2gtf and parameters of stages thru stage to
+      checkpoint_file(params, stage), replacing it atomically
+    '''
+
+    done = STAGES[:STAGES.index(stage) + 1]
+    checkpoint = {
+        'stage': stage,
+        'id2gtf': id2gtf,
+        'params': {name: getattr(params, name) for s in done for name in STAGE_PARAMS[s]},
+        'dat': dat,
+    }
+
+    file_out = checkpoint_file(params, stage)
+    try:
+        os.makedirs(params.checkpoint_dir, exist_ok=True)
+        with open(f"{file_out}.tmp", 'wb') as fh:
+            pickle.dump(checkpoint, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{file_out}.tmp", file_out)
+    except Exception as e:
+        raise Exception(f"save_checkpoint: for file_out {file_out}: {e}")
+
+
+def load_checkpoint(id2gtf, params):
+    '''
+    entry point
+    returns dat saved after the stage before params.resume_from; raises
+      Exception if id2gtf or parameters of earlier stages differ from
+      those of the checkpoint
+    '''
+
+    stage = STAGES[STAGES.index(params.resume_from) - 1]
+    file_in = checkpoint_file(params, stage)
+
+    try:
+        with open(file_in, 'rb') as fh:
+            checkpoint = pickle.load(fh)
+    except Exception as e:
+        raise Exception(f"load_checkpoint: for file_in {file_in}: {e}")
+
+    if checkpoint['id2gtf'] != id2gtf:
+        raise Exception(
+            f"load_checkpoint: gtf_list_file differs from that of {file_in}"
+        )
+
+    ## in stage order, so the earliest stage to redo is reported:
+    for name, value in checkpoint['params'].items():
+        if getattr(params, name) != value:
+            redo = [s for s in STAGES if name in STAGE_PARAMS[s]][0]
+            if redo == STAGES[0]:
+                advice = "rerun w/o --resume_from"
+            else:
+                advice = f"use --resume_from {redo} or an earlier stage"
+            raise Exception(
+                f"load_checkpoint: --{name} is {getattr(params, name)}, but "
+                f"{value} in {file_in}; {advice}"
+            )
+
+    return checkpoint['dat']
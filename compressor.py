@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""
+transparent gzip input and output; gzip and bgzip files are recognized
+  by their magic bytes; (de)compression runs in a helper thread that
+  talks to the caller thru a pipe, so zlib work, which releases the GIL,
+  overlaps parsing and formatting of text in the calling thread;
+  uncompressed input can also be memory-mapped, see map_input()
+"""
+
+## system:
+import contextlib
+import gzip
+import mmap
+import os
+import threading
+
+GZIP_MAGIC = b'\x1f\x8b'
+CHUNK_SIZE = 1 << 20
+
+
+def is_compressed(path):
+    '''
+    returns True if path is a gzip (or bgzip) file
+    '''
+
+    with open(path, 'rb') as fh:
+        return fh.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+
+
+def pump(fh_in, fh_out, errors):
+    '''
+    helper thread target; copies binary fh_in to fh_out in chunks, then
+      closes both; appends any exception to list errors
+    '''
+
+    try:
+        with fh_in, fh_out:
+            while True:
+                chunk = fh_in.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                fh_out.write(chunk)
+    except Exception as e:
+        errors.append(e)
+
+
+@contextlib.contextmanager
+def piped(fh_in, fh_out, fh_caller):
+    '''
+    runs pump(fh_in, fh_out) in a helper thread while yielding fh_caller,
+      the caller's end of the pipe; raises exception of the helper
+      thread, if any, once both are done
+    '''
+
+    errors = []
+    thread = threading.Thread(target=pump, args=(fh_in, fh_out, errors), daemon=True)
+    thread.start()
+
+    try:
+        yield fh_caller
+    finally:
+        fh_caller.close()
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+@contextlib.contextmanager
+def open_input(path, mode='r'):
+    '''
+    yields text (mode 'r') or binary (mode 'rb') file object for reading
+      path, which is decompressed in a helper thread if gzip or bgzip
+      compressed
+    '''
+
+    if not is_compressed(path):
+        with open(path, mode) as fh:
+            yield fh
+        return
+
+    fh_gz = gzip.open(path, 'rb')
+    fd_r, fd_w = os.pipe()
+
+    with piped(fh_gz, open(fd_w, 'wb'), open(fd_r, mode)) as fh:
+        yield fh
+
+
+@contextlib.contextmanager
+def map_input(path):
+    '''
+    yields object w/ readline() returning bytes lines of path: a
+      read-only memory map if path is uncompressed, else a binary file
+      object decompressed in a helper thread as for open_input()
+    '''
+
+    if is_compressed(path):
+        with open_input(path, 'rb') as fh:
+            yield fh
+        return
+
+    with open(path, 'rb') as fh:
+        if not os.fstat(fh.fileno()).st_size:
+            yield fh     ## empty files can not be mapped
+            return
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            yield buf
+
+
+@contextlib.contextmanager
+def open_output(path, mode='w', compress=False):
+    '''
+    yields text file object for writing (mode 'w') or appending (mode
+      'a') to path; if compress, text is gzip compressed in a helper
+      thread; appending adds a gzip member, which readers concatenate
+    '''
+
+    if not compress:
+        with open(path, mode) as fh:
+            yield fh
+        return
+
+    fh_gz = gzip.open(path, f"{mode}b", compresslevel=6)
+    fd_r, fd_w = os.pipe()
+
+    with piped(open(fd_r, 'rb'), fh_gz, open(fd_w, 'w')) as fh:
+        yield fh
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""
+binned interval index, as used by the UCSC genome browser and tabix;
+  each range is filed under the smallest bin that contains it, so a
+  query only visits ranges near it, plus the few long ranges filed
+  under large bins, no matter how long the longest range is
+"""
+
+## bins are 2 ** shift bp; sizes grow 8-fold per level from 16 kb:
+MIN_SHIFT = 14
+NEXT_SHIFT = 3
+
+
+def bin_shift(start, stop):
+    '''
+    returns shift of the smallest bin containing [start, stop]
+    '''
+
+    shift = MIN_SHIFT
+    while (start >> shift) != (stop >> shift):
+        shift += NEXT_SHIFT
+
+    return shift
+
+
+def build_index(starts, stops):
+    '''
+    Args:
+      starts, stops: in register; ranges are [starts[i], stops[i]]
+    Returns:
+      index = {'starts': starts, 'stops': stops, 'shifts': [shift, ...],
+        'bins': {(shift, bin): [i, ...], ...}} for query_index()
+    '''
+
+    bins = {}
+
+    for i, (start, stop) in enumerate(zip(starts, stops)):
+        shift = bin_shift(start, stop)
+        key = (shift, start >> shift)
+        if key not in bins:
+            bins[key] = []
+        bins[key].append(i)
+
+    shifts = sorted({key[0] for key in bins})
+
+    return {'starts': starts, 'stops': stops, 'shifts': shifts, 'bins': bins}
+
+
+def query_index(index, start, stop):
+    '''
+    returns ascending list of i w/ [starts[i], stops[i]] overlapping
+      [start, stop]
+    '''
+
+    starts = index['starts']
+    stops = index['stops']
+    bins = index['bins']
+    hits = []
+
+    for shift in index['shifts']:
+        for bin_i in range(start >> shift, (stop >> shift) + 1):
+            for i in bins.get((shift, bin_i), []):
+                if starts[i] <= stop and stops[i] >= start:
+                    hits.append(i)
+
+    hits.sort()
+
+    return hits
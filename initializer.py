@@ -14,6 +14,7 @@ import time
 
 ## local:
 
+import checkpointer
 import intypes
 import util
 
@@ -116,6 +117,71 @@ def build_parser():
         help="For each transcript, reverse order of negative strand exons"
     )
 
+    parser.add_argument(
+        "--threads",
+        type=intypes.strictly_positive_int,
+        default=1,
+        help="Number of worker processes for parsing, matching and overlapping transcripts"
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Merge coordinate-sorted GTF files one locus at a time, in bounded memory"
+    )
+
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="Add samples in gtf_list_file to the merge saved with --output_prefix"
+    )
+
+    parser.add_argument(
+        "--sweep",
+        metavar="GRID_FILE",
+        help="Tab-delimited file with 1 parameter name followed by comma-separated values per line; "
+             "ingests once, then merges w/ each combination of values"
+    )
+
+    parser.add_argument(
+        "--checkpoint_dir",
+        type=intypes.non_whitespace_str,
+        help="Directory for saving and loading checkpoints of merge stages"
+    )
+
+    parser.add_argument(
+        "--checkpoint_stages",
+        nargs="+",
+        choices=checkpointer.STAGES[:-1],
+        default=['ingest', 'resolve'],
+        help="Stages after which to save checkpoints to --checkpoint_dir"
+    )
+
+    parser.add_argument(
+        "--resume_from",
+        choices=checkpointer.STAGES[1:],
+        help="Stage to resume from, using the checkpoint of the stage before it"
+    )
+
+    parser.add_argument(
+        "--cache_dir",
+        type=intypes.non_whitespace_str,
+        help="Directory, which may be shared by concurrent jobs, for caching parsed input GTF files"
+    )
+
+    parser.add_argument(
+        "--cache_size",
+        type=intypes.strictly_positive_int,
+        default=10000,
+        help="Size limit (MB) of --cache_dir; least recently used entries are evicted beyond it"
+    )
+
+    parser.add_argument(
+        "--compress_output",
+        action="store_true",
+        help="Write output gtf and xref files gzip compressed, w/ suffix .gz"
+    )
+
     parser.add_argument(
 	    "--gene_prefix",
 	    type=intypes.non_whitespace_str,
@@ -141,6 +207,21 @@ def initialize():
     params = parser.parse_args()
     params.time_start = time_start
 
+    if params.stream and params.update:
+        parser.error("--stream and --update cannot be combined")
+
+    if params.sweep and (params.stream or params.update):
+        parser.error("--sweep cannot be combined w/ --stream or --update")
+
+    if (params.stream or params.update or params.sweep) and (params.checkpoint_dir or params.resume_from):
+        parser.error("checkpoints are not supported w/ --stream, --update or --sweep")
+
+    if params.resume_from and not params.checkpoint_dir:
+        parser.error("--resume_from requires --checkpoint_dir")
+
+    if params.stream and params.cache_dir:
+        parser.error("--cache_dir is not supported w/ --stream")
+
     print(
         f"version: {version}\n"
         f"begin: {util.time_stamp()}\n"
@@ -158,6 +239,16 @@ def initialize():
         'rev_neg_exons',
         'sort_exons',
         'max_intron_length',
+        'threads',
+        'stream',
+        'update',
+        'sweep',
+        'checkpoint_dir',
+        'checkpoint_stages',
+        'resume_from',
+        'cache_dir',
+        'cache_size',
+        'compress_output',
         'output_prefix',
     ]
 
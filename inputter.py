@@ -6,58 +6,101 @@ parses gtf file; assumes input gtf has exon features that have
 """
 
 ## system:
-import re
+import array
+import functools
+import heapq
+import itertools
+import multiprocessing
+import operator
+import os
 import sys
+import time
 
 ## local:
+import cacher
+import compressor
+import storer
 import util
 
 
 ###############################################################################
 ## ingest gtf file stuff:
 
+EXON_TAG = b'\texon\t'
+
+
+def read_exon_toks(gtf):
+    '''
+    generator yielding tab-split bytes fields of each exon line in gtf,
+      in file order; gtf is memory-mapped, and lines w/o EXON_TAG are
+      skipped w/o being split or decoded
+    '''
+
+    with compressor.map_input(gtf) as fh:
+        for line in iter(fh.readline, b''):
+            if EXON_TAG not in line:
+                continue
+            toks = line.strip().split(b'\t')
+            if toks[0].startswith(b'#'):
+                continue
+            if len(toks) != 9:
+                raise Exception(f"ncolumns != 9 on line: {line.decode()}")
+            if toks[2] != b'exon':
+                continue
+            yield toks
+
+
+def scan_attribute(tok9, key):
+    '''
+    returns value of attribute key in tok9, w/o quotes, or None if key 
+      absent; only whole attribute names match, so 'gene_id' will not
+      match 'ref_gene_id'
+    '''
+
+    value = None
+    n_key = len(key)
+    pos = tok9.find(key)
+
+    while pos >= 0:
+        end = pos + n_key
+        if (pos == 0 or tok9[pos - 1] in ' ;') and tok9.startswith(' ', end):
+            if value is not None:
+                raise Exception(f"parse_attributes: multiple {key}s in {tok9}")
+            rest = tok9[end:].lstrip(' ')
+            if rest.startswith('"'):
+                value = rest[1:].split('"', 1)[0]
+            else:
+                value = rest.split(';', 1)[0].split(' ', 1)[0]
+        pos = tok9.find(key, end)
+
+    return value
+
+
+@functools.lru_cache(maxsize=4096)
 def parse_attributes(tok9, prefix='None'):
     '''
     Args:
-      gene_id "PB.38"; transcript_id "PB.38.1";
+      b'gene_id "PB.38"; transcript_id "PB.38.1";'
     Returns: 
-      tuple (gene_id, transcript_id)
+      tuple (transcript_id, gene_id)
+    Results are cached on tok9, so exons of a transcript that share an 
+      attribute string are only decoded and scanned once
     '''
 
     if prefix is None:
         prefix = ''
 
-    toks = re.split('; |;| ', tok9)
-    toks = [tok.strip('"') for tok in toks]
-
-    transcript_id = None
-    gene_id = None
-    idx_last = len(toks) - 1
-    idx = 0
-
-    while(idx < idx_last):
-        if toks[idx] == 'transcript_id':
-            if transcript_id:
-                raise Exception(f"parse_attributes: multiple transcript_ids in {tok9}")
-            else:
-                transcript_id = f"{prefix}:{toks[idx + 1]}"
-                idx += 2
-        elif toks[idx] == 'gene_id':
-            if gene_id:
-                raise Exception(f"parse_attributes: multiple gene_ids in {tok9}")
-            else:
-                gene_id = f"{prefix}:{toks[idx + 1]}"
-                idx += 2
-        else:
-            idx += 1
+    tok9 = tok9.decode()
 
+    transcript_id = scan_attribute(tok9, 'transcript_id')
     if transcript_id is None:
         raise Exception(f"no transcript_id found in attributes {tok9}")
 
+    gene_id = scan_attribute(tok9, 'gene_id')
     if gene_id is None:
         raise Exception(f"no gene_id found in attributes {tok9}")
 
-    return transcript_id, gene_id
+    return f"{prefix}:{transcript_id}", f"{prefix}:{gene_id}"
 
 
 def parse_toks(toks, label):
@@ -69,25 +112,26 @@ def parse_toks(toks, label):
     except Exception as e:
         raise Exception(f"parse_toks:1: {e}")
 
-    if toks[6] == '+':
+    if toks[6] == b'+':
         strand = 1
-    elif toks[6] == '-':
+    elif toks[6] == b'-':
         strand = 0
     else:
         raise Exception(
-            f"parse_toks:2: unexpected strand '{toks[6]}'"
+            f"parse_toks:2: unexpected strand '{toks[6].decode()}'"
         )
 
     return start, end, strand, transcript_id, gene_id
 
 
-def ingest_exon(label, toks, id2idx, dat):
+def ingest_exon(label, toks, id2idx, dat, staged):
     '''
     Args:
       label: label for gtf file to be prepended to sequence ids
-      toks: tokens from exon line in gtf file
+      toks: bytes tokens from exon line in gtf file
+      staged: exon columns plus 'rnas' transcript indices for current file
     Returns: None
-    Side-effect: updates dat
+    Side-effect: updates dat and staged
 
     KI270721.1    .    exon    50359   50976  40  -   .   gene_id "PB.38"; transcript_id "PB.38.1";
     '''
@@ -95,12 +139,13 @@ def ingest_exon(label, toks, id2idx, dat):
     try: 
         start, end, strand, transcript_id, gene_id = parse_toks(toks, label)
     except Exception as e:
-        raise Exception(f"ingest_exon: for label {label}; toks {toks}: {e}")
+        raise Exception(f"ingest_exon: for label {label}; toks {[tok.decode() for tok in toks]}: {e}")
 
-    ## register chromosome:
+    ## register chromosome; chr2idx is keyed on bytes, so only new 
+    ## chromosomes are decoded:
     chr_idx = dat['chr2idx'].get(toks[0])
     if chr_idx is None:
-        dat['chrs'].append(toks[0])
+        dat['chrs'].append(toks[0].decode())
         chr_idx = len(dat['chrs']) - 1
         dat['chr2idx'][toks[0]] = chr_idx
 
@@ -108,54 +153,186 @@ def ingest_exon(label, toks, id2idx, dat):
     rna_idx = id2idx.get(transcript_id)
 
     if rna_idx is None:
-        dat['transcripts'].append([])
         dat['old_ids'].append(transcript_id)
         dat['old_genes'].append(gene_id)
-        rna_idx = len(dat['transcripts']) - 1
+        rna_idx = len(dat['old_ids']) - 1
         id2idx[transcript_id] = rna_idx
 
-    dat['transcripts'][rna_idx].append([chr_idx, strand, start, end])
+    staged['rnas'].append(rna_idx)
+    staged['exon_chrs'].append(chr_idx)
+    staged['exon_strands'].append(strand)
+    staged['exon_starts'].append(start)
+    staged['exon_ends'].append(end)
 
 
-def sort_exons(dat):
-    for exons in dat['transcripts']:
+def sort_exons(dat, first=0):
+    for idx in range(first, storer.n_transcripts(dat)):
+        exons = storer.get_exons(dat, idx)
         exons.sort(key=lambda exon: (exon[2], exon[3]))
+        storer.set_exons(dat, idx, exons)
 
 
-def rev_neg_exons(dat):
-    for idx, exons in enumerate(dat['transcripts']):
+def rev_neg_exons(dat, first=0):
+    for idx in range(first, storer.n_transcripts(dat)):
+        exons = storer.get_exons(dat, idx)
         if exons[0][1] == 0:   ## first exon on negative strand
             exons.reverse()
+            storer.set_exons(dat, idx, exons)
 
 
-def ingest_gtf_file(label, gtf, dat, params):
+def parse_gtf_file(label, gtf):
     '''
-    entry point
     Args:
       label: label for gtf file to be prepended to sequence ids
       gtf: path to gtf file
-      dat: data structure to be updated
-      params: run-time configuration parameters
-    Returns: None
-    Side-effect: updates dat
+    Returns: sample dict w/ keys 'chrs', 'chr2idx', 'old_ids', 
+      'old_genes' and exon store laid out as in dat, but 
+      w/ chromosome and transcript indices local to gtf and 'chr2idx' 
+      keyed on bytes, plus 'n_bytes' (file size) and 'seconds' for 
+      reporting throughput
     '''
 
+    time_start = time.time()
+
+    sample = {
+        'chrs': [],
+        'chr2idx': {},
+        **storer.new_store(),
+        'old_ids': [],
+        'old_genes': [],
+    }
+
+    staged = storer.new_columns()
+    staged['rnas'] = array.array('q')
+
     try:
-        with open(gtf, 'r') as fh:
-            id2idx = {}
-            for line in fh:
-                toks = line.strip().split('\t')
-                if not toks:
-                    continue
-                if toks[0].startswith('#'):
-                    continue
-                if len(toks) != 9:
-                    raise Exception(f"ncolumns != 9 on line: {line}")
-                if toks[2] != 'exon':
-                    continue
-                ingest_exon(label, toks, id2idx, dat)
+        id2idx = {}
+        for toks in read_exon_toks(gtf):
+            ingest_exon(label, toks, id2idx, sample, staged)
+        sample['n_bytes'] = os.path.getsize(gtf)
     except Exception as e:
-        raise Exception(f"ingest_gtf_file: for {label}; {gtf}: {e}")
+        raise Exception(f"parse_gtf_file: for {label}; {gtf}: {e}")
+
+    ## group exons by transcript into sample exon store:
+    storer.append_exons(sample, staged)
+    storer.drop_index(sample)
+
+    sample['seconds'] = time.time() - time_start
+
+    return sample
+
+
+def load_gtf_file(label, gtf, params):
+    '''
+    returns sample for gtf as for parse_gtf_file(); w/ params.cache_dir,
+      the sample is loaded from the cache if there, w/ 'cached' True, 
+      else parsed and, if possible, saved to the cache
+    '''
+
+    if not params.cache_dir:
+        return parse_gtf_file(label, gtf)
+
+    time_start = time.time()
+
+    try:
+        file_cache = cacher.cache_file(label, gtf, params)
+    except Exception as e:
+        raise Exception(f"load_gtf_file: for {label}; {gtf}: {e}")
+
+    sample = cacher.load_sample(file_cache)
+
+    if sample is None:
+        sample = parse_gtf_file(label, gtf)
+        cacher.save_sample(sample, file_cache, params)
+    else:
+        sample['cached'] = True
+        sample['seconds'] = time.time() - time_start
+
+    return sample
+
+
+def throughput(n_bytes, seconds):
+    '''
+    returns str reporting n_bytes processed in seconds, in MB and MB/s
+    '''
+
+    mb = n_bytes / 1e6
+    return f"{mb:.1f} MB in {seconds:.2f} s, {mb / max(seconds, 1e-6):.1f} MB/s"
+
+
+def parse_gtf_item(item):
+    '''
+    process pool worker; item is (label, gtf, params)
+    '''
+
+    return load_gtf_file(*item)
+
+
+def merge_sample(dat, sample):
+    '''
+    appends sample from parse_gtf_file() to dat, registering new 
+      chromosomes in sample order and renumbering transcripts to follow
+      those already in dat
+    '''
+
+    chr_map = []
+
+    for chr_id in sample['chrs']:
+        chr_idx = dat['chr2idx'].get(chr_id)
+        if chr_idx is None:
+            dat['chrs'].append(chr_id)
+            chr_idx = len(dat['chrs']) - 1
+            dat['chr2idx'][chr_id] = chr_idx
+        chr_map.append(chr_idx)
+
+    storer.extend_exons(dat, sample, chr_map)
+    dat['old_ids'].extend(sample['old_ids'])
+    dat['old_genes'].extend(sample['old_genes'])
+
+
+def ingest_gtf_files(id2gtf, dat, params):
+    '''
+    entry point
+    Args:
+      id2gtf: dict {label: gtf} from ingest_gtf_list_file()
+      dat: data structure to be updated
+      params: run-time configuration parameters; params.threads
+        worker processes parse files concurrently
+    Returns: None
+    Side-effect: updates dat in id2gtf order, so result does not depend
+      on params.threads; reports ingestion throughput per file and 
+      overall in MB/s
+    '''
+
+    items = [(label, gtf, params) for label, gtf in id2gtf.items()]
+    time_start = time.time()
+    n_bytes = 0
+
+    if params.threads < 2 or len(items) < 2:
+        for label, gtf, params in items:
+            print(f"{util.elapsed(params)}: ingesting {label}: {gtf}")
+            sample = load_gtf_file(label, gtf, params)
+            merge_sample(dat, sample)
+            print(
+                f"{util.elapsed(params)}: ingested {label}{' from cache' if sample.get('cached') else ''}: "
+                f"{throughput(sample['n_bytes'], sample['seconds'])}"
+            )
+            n_bytes += sample['n_bytes']
+    else:
+        n_procs = min(params.threads, len(items))
+        print(f"{util.elapsed(params)}: ingesting w/ {n_procs} processes")
+
+        with multiprocessing.Pool(n_procs) as pool:
+            for item, sample in zip(items, pool.imap(parse_gtf_item, items)):
+                print(
+                    f"{util.elapsed(params)}: ingested {item[0]}: {item[1]}"
+                    f"{' from cache' if sample.get('cached') else ''}: "
+                    f"{throughput(sample['n_bytes'], sample['seconds'])}"
+                )
+                merge_sample(dat, sample)
+                n_bytes += sample['n_bytes']
+
+    print(f"{util.elapsed(params)}: ingested {len(items)} files: {throughput(n_bytes, time.time() - time_start)}")
 
 
 ###############################################################################
@@ -189,59 +366,89 @@ def ingest_gtf_list_file(gtf_list_file):
     return id2gtf
 
 
-def identify_fusions(dat, params):
+def transcript_is_fusion(transcript, params):
     '''
-    entrypoint
-    updates dat['is_fusion'] based on dat['transcripts']
+    returns True if exons of transcript, [(chr, strand, start, end), ...],
+      are on different chromosomes or strands, out of order, or 
+      separated by an intron longer than params.max_intron_length
     '''
 
-    transcripts = dat['transcripts']
-    is_fusion = dat['is_fusion']
+    chrom = transcript[0][0]
+    strand = transcript[0][1]
+    last_end = transcript[0][2]   ## first exon start
 
-    for transcript in transcripts:
+    for exon in transcript:
 
-        fusion = False
-        chrom = transcript[0][0]
-        strand = transcript[0][1]
-        last_end = transcript[0][2]   ## first exon start
+        if chrom != exon[0]:
+            return True           ## exons on different chromosomes
+        elif strand != exon[1]:
+            return True           ## exons on different strands
+        elif exon[2] < last_end: 
+            return True           ## exons in wrong order
+        elif (exon[2] - last_end) > params.max_intron_length:
+            return True           ## intron between successive exons too big
+        else:
+            last_end = exon[3]    ## update end of last exon
 
-        for exon in transcript:
+    return False
 
-            if chrom != exon[0]:
-                fusion = True         ## exons on different chromosomes
-            elif strand != exon[1]:
-                fusion = True         ## exons on different strands
-            elif exon[2] < last_end: 
-                fusion = True         ## exons in wrong order
-            elif (exon[2] - last_end) > params.max_intron_length:
-                fusion = True         ## intron between successive exons too big
-            else:
-                last_end = exon[3]    ## update end of last exon
 
-            if fusion:
-                break
+def identify_fusions(dat, params):
+    '''
+    entrypoint
+    extends dat['is_fusion'] based on dat exon store, for transcripts
+      not yet classified
+    '''
+
+    is_fusion = dat['is_fusion']
 
-        is_fusion.append(fusion)
+    for idx in range(len(is_fusion), storer.n_transcripts(dat)):
+        transcript = storer.get_exons(dat, idx)
+        is_fusion.append(transcript_is_fusion(transcript, params))
 
 
 def populate_tranges(dat, params):
     '''
-    populate dat['tranges'] using info from dat['transcripts']
+    populate dat['tranges'] using info from dat exon store; skips
+      transcripts collapsed into others by dat['xrefs']; tranges of each
+      (chromosome, strand) are sorted on (start, end), unless already
+      in order, e.g. when from a single coordinate-sorted gtf
     '''
 
     tranges = dat['tranges']
+    xrefs = dat['xrefs']
+    is_fusion = dat['is_fusion']
+    offsets = dat['offsets']
+    exon_ids = dat['exon_ids']
+    ends = dat['exon_ends']
+
+    ## in register w/ tranges; (start, end) of each:
+    keys = []
 
     for chr_i in dat['chrs']:
-        tranges.append([])
+        tranges.append([[], []])       ## by strand
+        keys.append([[], []])
+
+    for i_transcript in range(storer.n_transcripts(dat)):
+
+        if i_transcript in xrefs:
+            continue
 
-    for i_transcript, transcript in enumerate(dat['transcripts']):
+        i0 = offsets[i_transcript]
+        i1 = offsets[i_transcript + 1]
 
-        if not transcript:
+        if not is_fusion[i_transcript]:
+            ## all exons on one chromosome and strand, in ascending,
+            ##   non-overlapping order:
+            i_chr, i_strand, start, end = storer.get_exon(dat, exon_ids[i0])
+            end = ends[exon_ids[i1 - 1]]
+            tranges[i_chr][i_strand].append([start, end, i_strand, i_transcript])
+            keys[i_chr][i_strand].append((start, end))
             continue
 
         ## each entry corresponds to a genomic segment of transcript:
         chrstrands = {}         ## (chr, strand): [start, end]
-        for exon in transcript:
+        for exon in storer.get_exons(dat, i_transcript):
             k = (exon[0], exon[1])
             if k not in chrstrands:
                 chrstrands[k] = [sys.maxsize, -1]
@@ -253,10 +460,63 @@ def populate_tranges(dat, params):
         for k, v in chrstrands.items():
             i_chr, i_strand = k
             start, end = v
-            tranges[i_chr].append([start, end, i_strand, i_transcript])
+            tranges[i_chr][i_strand].append([start, end, i_strand, i_transcript])
+            keys[i_chr][i_strand].append((start, end))
 
+    ## ties are left in order of idx, as appended:
     print(f"  {util.elapsed(params)}: sorting tranges")
-    for chr_i in tranges:
-        chr_i.sort(key=lambda item: tuple(item[:]))
+    for tranges_chr, keys_chr in zip(tranges, keys):
+        for strand_tranges, keys_i in zip(tranges_chr, keys_chr):
+            if all(map(operator.le, keys_i, itertools.islice(keys_i, 1, None))):
+                continue
+            perm = sorted(range(len(keys_i)), key=keys_i.__getitem__)
+            strand_tranges[:] = [strand_tranges[i] for i in perm]
+
+    order_transcripts(dat)
+
+
+def chr_tranges(dat, idx_chr):
+    '''
+    returns iterator over tranges of chromosome idx_chr on both strands,
+      in (start, end, strand, idx) order
+    '''
+
+    return heapq.merge(*dat['tranges'][idx_chr])
+
+
+def order_transcripts(dat):
+    '''
+    populates dat['order'] w/ index of each transcript in dat['tranges'],
+      in order of its first trange; this is the order in which kept
+      transcripts are named and written
+    '''
+
+    order = array.array('q')
+    seen = bytearray(storer.n_transcripts(dat))
+
+    for idx_chr in range(len(dat['tranges'])):
+        for trange in chr_tranges(dat, idx_chr):
+            idx = trange[3]
+            if not seen[idx]:
+                seen[idx] = 1
+                order.append(idx)
+
+    dat['order'] = order
+
+
+def filter_tranges(dat):
+    '''
+    drops tranges of transcripts collapsed into others by dat['xrefs'],
+      compacting each (chromosome, strand) list in place; remaining
+      tranges stay sorted, so spans are neither recomputed nor sorted
+    '''
+
+    xrefs = dat['xrefs']
+
+    for tranges_chr in dat['tranges']:
+        for strand_tranges in tranges_chr:
+            strand_tranges[:] = [trange for trange in strand_tranges if trange[3] not in xrefs]
+
+    order_transcripts(dat)
 
 
@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
 
 ## system:
+import array
 import sys
 import time
 
 ## local:
+import checkpointer
 import initializer
 import inputter
 import namer
 import outputter
 import overlapper
 import resolver
+import storer
+import streamer
+import sweeper
+import updater
 import util
 
 '''
@@ -22,9 +28,18 @@ dat = {
   chr2idx: {chr_id0: 0, chr_id1: 1, chr_id2: 2, ...}
 
   ## strand == '-': 0; strand == '+': 1;
-  ## exon = [seq, strand, start, end]
-  ## transcript = [exon1, exon2, ...]
-  transcripts: [transcript0, transcript1, transcript2, ...]
+  ## interned exon store; each distinct exon is kept once, at position
+  ##   exon_id of the exon_* columns, and exon ids of transcript idx 
+  ##   are exon_ids[i] for i in range(offsets[idx], offsets[idx + 1])
+  ##   (all array.array); exon2id: {(chr_idx, strand, start, end): 
+  ##   exon_id, ...} is only present while exons are added:
+  exon_chrs: [chr_idx0, chr_idx1, ...]
+  exon_strands: [strand0, strand1, ...]
+  exon_starts: [start0, start1, ...]
+  exon_ends: [end0, end1, ...]
+  exon_ids: [exon_id0, exon_id1, ...]
+  offsets: [0, n_exons0, n_exons0 + n_exons1, ...]
+
   ## in register w/ transcripts; True only if exons on different 
   ##   chromosomes or if: 
   ##     abs(exon[i+1].start - exon[i].end) > params.max_intron_size
@@ -39,54 +54,35 @@ dat = {
   ## gene_ids: f'{label}:{gtf_gene_id}'
   old_genes: [gene_id0, gene_id1, gene_id2, ... ]
 
-  ## tranges[i] corresponds to chrs[i]; transcript is transcripts[idx]:
-  tranges: [[[start, end, strand, idx], ...], ...] 
+  ## tranges[i][strand] corresponds to chrs[i]; idx is transcript index:
+  tranges: [[[[start, end, strand, idx], ...], [...]], ...] 
+  ## kept idx in order of first trange; order of naming and output:
+  order: [idx, ...]
 
-  ## initially, *_transcript = transcripts[*_idx]:
+  ## collapsed transcripts are omitted from later tranges:
   xrefs = { collapsed_idx: kept_idx, ... }  
   ## later, kept is True or False; others are strings:
   xrefs = [[old_id1, old_gene1, new_id1, new_gene1, kept1], ...]
 
-  ## transcript1 = transcripts[idx1]:
-  olaps = { idx1: {idx2, idx3, ...}, idx2: {idx1, idx3, ...}, ... }
+  ## gene clusters; idx is transcript index; disjoint-set forest in
+  ##   register w/ transcripts; root_idx is first transcript of cluster:
+  parents: [parent_idx0, parent_idx1, ...]
+  ranks: [rank0, rank1, ...]
+  ## fusions, and non-fusions linked to several clusters:
+  olaps = { idx1: {root_idx1, root_idx2, ...}, ... }
+
+  ## number of genes named f'{gene_prefix}{n}', once named:
+  n_genes: n
 }
 '''
 
 ###############################################################################
-## main:
-
-if __name__ == '__main__':
-
-    params = initializer.initialize()
-
-    print(f"{util.elapsed(params)}: parsing gtf_list_file:")
-    try:
-        id2gtf = inputter.ingest_gtf_list_file(params.gtf_list_file)
-    except Exception as e:
-        sys.stderr.write(f"ERROR:31: {e}\n")
-        sys.exit(31)
+## stages:
 
-    dat = {
-        ## seq_name: f'{label}:{seqid}'
-        'chrs': [],
-        'chr2idx': {},
-        ## exon = [seq, strand, start, end]
-        ## transcript = [exon1, exon2, ...]
-        'transcripts': [],
-        'is_fusion': [],
-        'old_ids': [],
-        'old_genes': [],
-        'new_ids': [],
-        'new_genes': [],
-        'tranges': [],
-        'xrefs': {},
-        'olaps': {}
-    }
+def ingest_stage(dat, id2gtf, params):
 
     try:
-        for label, gtf in id2gtf.items():
-            print(f"{util.elapsed(params)}: ingesting {label}: {gtf}")
-            inputter.ingest_gtf_file(label, gtf, dat, params)
+        inputter.ingest_gtf_files(id2gtf, dat, params)
     except Exception as e:
         sys.stderr.write(f"ERROR:33: {e}\n")
         sys.exit(33)
@@ -98,31 +94,54 @@ if __name__ == '__main__':
         print(f"{util.elapsed(params)}: reversing negative strand exon order")
         inputter.rev_neg_exons(dat)
 
+    ## no exons added past ingestion:
+    storer.drop_index(dat)
+
+
+def fusions_stage(dat, id2gtf, params):
+
     print(f"{util.elapsed(params)}: identifying fusions")
     inputter.identify_fusions(dat, params)
 
+
+def tranges_stage(dat, id2gtf, params):
+
     print(f"{util.elapsed(params)}: populating tranges")
     inputter.populate_tranges(dat, params)
 
+
+def xref_stage(dat, id2gtf, params):
+
     print(f"{util.elapsed(params)}: cross-referencing transcripts")
     resolver.xref_transcripts(dat, params)
 
+
+def resolve_stage(dat, id2gtf, params):
+
     print(f"{util.elapsed(params)}: resolving xrefs")
     resolver.resolve_xrefs(dat)
 
-    print(f"{util.elapsed(params)}: repopulating tranges")
-    dat['tranges'] = []
-    inputter.populate_tranges(dat, params)
+    print(f"{util.elapsed(params)}: filtering tranges")
+    inputter.filter_tranges(dat)
+
+
+def overlaps_stage(dat, id2gtf, params):
 
     print(f"{util.elapsed(params)}: finding transcript overlaps")
     overlapper.find_overlaps(dat, params,)
 
+
+def naming_stage(dat, id2gtf, params):
+
     print(f"{util.elapsed(params)}: naming genes")
-    namer.name_genes(dat, params)
+    dat['n_genes'] = namer.name_genes(dat, params)
 
     print(f"{util.elapsed(params)}: naming transcripts")
     namer.name_transcripts(dat)
 
+
+def output_stage(dat, id2gtf, params):
+
     print(f"{util.elapsed(params)}: writing xref file")
     try:
         outputter.write_xref_file(dat, params)
@@ -137,9 +156,119 @@ if __name__ == '__main__':
         sys.stderr.write(f"ERROR:53: {e}\n")
         sys.exit(53)
 
+    print(f"{util.elapsed(params)}: saving merge state")
+    try:
+        updater.save_state(dat, params, id2gtf, dat['n_genes'])
+    except Exception as e:
+        sys.stderr.write(f"ERROR:55: {e}\n")
+        sys.exit(55)
+
     outputter.report(dat)
 
+
+## in checkpointer.STAGES order:
+stage_funcs = {
+    'ingest': ingest_stage,
+    'fusions': fusions_stage,
+    'tranges': tranges_stage,
+    'xref': xref_stage,
+    'resolve': resolve_stage,
+    'overlaps': overlaps_stage,
+    'naming': naming_stage,
+    'output': output_stage,
+}
+
+###############################################################################
+## main:
+
+if __name__ == '__main__':
+
+    params = initializer.initialize()
+
+    print(f"{util.elapsed(params)}: parsing gtf_list_file:")
+    try:
+        id2gtf = inputter.ingest_gtf_list_file(params.gtf_list_file)
+    except Exception as e:
+        sys.stderr.write(f"ERROR:31: {e}\n")
+        sys.exit(31)
+
+    if params.stream:
+        try:
+            state = streamer.stream_gtf_files(id2gtf, params)
+        except Exception as e:
+            sys.stderr.write(f"ERROR:35: {e}\n")
+            sys.exit(35)
+
+        streamer.report(state)
+
+        print(f"{util.elapsed(params)}: completed")
+        print(f"finished: {util.time_stamp()}")
+        sys.exit(0)
+
+    if params.update:
+        try:
+            updater.update_gtf_files(id2gtf, params)
+        except Exception as e:
+            sys.stderr.write(f"ERROR:37: {e}\n")
+            sys.exit(37)
+
+        print(f"{util.elapsed(params)}: completed")
+        print(f"finished: {util.time_stamp()}")
+        sys.exit(0)
+
+    stages = checkpointer.STAGES
+
+    if params.sweep:
+        ## stages after tranges are repeated for each setting:
+        stages = stages[:stages.index('tranges') + 1]
+
+    if params.resume_from:
+        print(f"{util.elapsed(params)}: loading checkpoint to resume from {params.resume_from}")
+        try:
+            dat = checkpointer.load_checkpoint(id2gtf, params)
+        except Exception as e:
+            sys.stderr.write(f"ERROR:39: {e}\n")
+            sys.exit(39)
+        stages = stages[stages.index(params.resume_from):]
+    else:
+        dat = {
+            ## seq_name: f'{label}:{seqid}'
+            'chrs': [],
+            'chr2idx': {},
+            ## exon store; transcript idx exon ids at offsets[idx]:offsets[idx + 1]
+            **storer.new_store(),
+            'is_fusion': [],
+            'old_ids': [],
+            'old_genes': [],
+            'new_ids': [],
+            'new_genes': [],
+            'tranges': [],
+            'order': array.array('q'),
+            'xrefs': {},
+            'parents': array.array('q'),
+            'ranks': array.array('b'),
+            'olaps': {}
+        }
+
+    for stage in stages:
+
+        stage_funcs[stage](dat, id2gtf, params)
+
+        if params.checkpoint_dir and stage in params.checkpoint_stages:
+            print(f"{util.elapsed(params)}: saving checkpoint after {stage}")
+            try:
+                checkpointer.save_checkpoint(dat, id2gtf, params, stage)
+            except Exception as e:
+                sys.stderr.write(f"ERROR:39: {e}\n")
+                sys.exit(39)
+
+    if params.sweep:
+        try:
+            sweeper.sweep(dat, params)
+        except Exception as e:
+            sys.stderr.write(f"ERROR:43: {e}\n")
+            sys.exit(43)
+
     print(f"{util.elapsed(params)}: completed")
     print(f"finished: {util.time_stamp()}")
     sys.exit(0)
-
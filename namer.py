@@ -2,140 +2,107 @@ import sys
 
 ## local:
 
-import util
+import overlapper
+import storer
 
 def name_transcripts(dat):
     '''
-    populates dat['new_ids'] using dat['olaps']
+    populates dat['new_ids'] using dat['new_genes']
     '''
 
-    olaps = dat['olaps']
-    tranges_chr = dat['tranges']
     new_genes = dat['new_genes']
-    dat['new_ids'] = [None] * len(dat['transcripts'])
+    dat['new_ids'] = [None] * storer.n_transcripts(dat)
     new_ids = dat['new_ids']
-    done = set()
     counts = {}
 
-    for trange_chr in tranges_chr:     ## in original chromosome order
-        for trange in trange_chr:      ## in (start, end) order
-            idx = trange[3]            ## transcript = dat['transcripts'][idx]
-            if idx in done:
-                continue
-            gene = new_genes[idx]
-            if gene not in counts:
-                counts[gene] = 0
-            counts[gene] += 1
-            new_ids[idx] = f"{gene}.{counts[gene]}"
-            done.add(idx)
+    for idx in dat['order']:           ## exons = storer.get_exons(dat, idx)
+        gene = new_genes[idx]
+        if gene not in counts:
+            counts[gene] = 0
+        counts[gene] += 1
+        new_ids[idx] = f"{gene}.{counts[gene]}"
 
 
-def name_genes_i(dat, params, name_fusions=False, n_genes=0):
+def fusion_gene(genes, params, n_genes):
     '''
-    populates dat['new_genes'] using dat['olaps']
+    returns (gene, n_genes) for a fusion sharing genes w/ non-fusions in
+      list genes, as name_genes() names fusions: a new gene if genes
+      is empty, the one gene if only one, else 'fusion:gene1:gene2...'
     '''
 
-    olaps = dat['olaps']
-    is_fusion = dat['is_fusion']
-    tranges_chr = dat['tranges']
-    new_genes = dat['new_genes']
-    prefix = params.gene_prefix
-
-    for trange_chr in tranges_chr:     ## in original chromosome order
-        for trange in trange_chr:      ## in (start, end) order
-            idx = trange[3]            ## transcript = dat['transcripts'][idx]
-            if new_genes[idx] is not None:
-                continue
-            if is_fusion[idx] != name_fusions:
-                continue
-            links = olaps.get(idx)
-            if idx in links:
-                n_genes += 1
-                new_genes[idx] = f"{prefix}{n_genes}"
-            elif len(links) == 1:
-                link_idx = list(links)[0]
-                link_gene = new_genes[link_idx]
-                if link_gene is not None:
-                    new_genes[idx] = link_gene
-            elif is_fusion[idx]:
-                nom = 'fusion'
-                for i in links:
-                    nom += f':{new_genes[i]}'
-                new_genes[idx] = nom
-            else:
-                ## this is a strange situation:
-                nom = None
-                for i in list(olaps[idx]):
-                    if new_genes[i] is not None:
-                        nom = new_genes[i]
-                        break
-                if nom is not None:
-                    new_genes[idx] = nom
-                else:
-                    n_genes += 1
-                    new_genes[idx] = f"{prefix}{n_genes}"
-
-    return n_genes
-
-
-def none_gene_found(dat, check_fusions=False):
-
-    new_genes = dat['new_genes']
-    is_fusion = dat['is_fusion']
-
-    for tranges_chr in dat['tranges']:
-        for trange in tranges_chr:
-            transcript_idx = trange[3]
-            if is_fusion[transcript_idx] != check_fusions:
-                continue
-            if new_genes[transcript_idx] is None:
-                return True
+    if not genes:
+        n_genes += 1
+        return f"{params.gene_prefix}{n_genes}", n_genes
 
-    return False
+    if len(genes) == 1:
+        return genes[0], n_genes
 
+    nom = 'fusion'
+    for gene in genes:
+        nom += f':{gene}'
 
-def name_genes(dat, params):
-    '''
-    populates dat['new_genes'] using dat['olaps']
-    '''
-
-    dat['new_genes'] = [None] * len(dat['transcripts'])
-
-    n_genes = 0
+    return nom, n_genes
 
-    while none_gene_found(dat, False):
-        print(f"{util.elapsed(params)}: naming non-fusions;")
-        n_genes = name_genes_i(dat, params, False, n_genes)
 
-    while none_gene_found(dat, True):
-        print(f"{util.elapsed(params)}: naming fusions;")
-        n_genes = name_genes_i(dat, params, True, n_genes)
-
-
-def xref_table(dat, params):
+def name_genes(dat, params, n_genes=0, first_named=False):
     '''
-    repopulates dat['xref'] 
+    populates dat['new_genes'] using clusters from overlapper, in one
+      traversal of dat['order']; genes are numbered from n_genes + 1
+      in that order, non-fusions before fusions; a transcript linked to
+      several genes gets the first of them in iteration order of its
+      cluster roots, and a fusion lists them in that order; w/ 
+      first_named, as for --stream windows, it gets the one named first
+      and a fusion lists them in naming order instead, so names do not
+      depend on transcript indices; returns number of genes named 
+      f"{params.gene_prefix}{n}"
     '''
 
-    xref_table = []
-    old_ids = dat['old_ids']
-    old_genes = dat['old_genes']
-    new_ids = dat['new_ids']
+    is_fusion = dat['is_fusion']
+    parents = dat['parents']
+    dat['new_genes'] = [None] * storer.n_transcripts(dat)
     new_genes = dat['new_genes']
-    xrefs = dat['xrefs']
-
-    for idx, vals in enumerate(zip(old_ids, old_genes, new_ids, new_genes)):
-        old_id, old_gene, new_id, new_gene = vals
-        if new_id is None:
-            kept = False
-            idx_kept = xrefs[idx]
-            new_id = new_ids[idx_kept]
-            new_gene = new_genes[idx_kept]
+    prefix = params.gene_prefix
+    deferred = []                      ## linked to a root not yet named
+    gene_nums = {}                     ## gene: n, in order of naming
+    fusions = []                       ## in order of first trange
+
+    for idx in dat['order']:           ## exons = storer.get_exons(dat, idx)
+        if is_fusion[idx]:
+            fusions.append(idx)
+            continue
+        links = overlapper.cluster_roots(dat, idx)
+        if idx in links:
+            n_genes += 1
+            new_genes[idx] = f"{prefix}{n_genes}"
+            gene_nums[new_genes[idx]] = n_genes
+        elif len(links) == 1:
+            link_idx = list(links)[0]
+            link_gene = new_genes[link_idx]
+            if link_gene is not None:
+                new_genes[idx] = link_gene
+            else:
+                deferred.append(idx)
         else:
-            kept = True
-
-        xref_table.append([old_id, old_gene, new_id, new_gene, kept])
+            ## this is a strange situation:
+            genes = [new_genes[i] for i in links if new_genes[i] is not None]
+            if genes and first_named:
+                new_genes[idx] = min(genes, key=gene_nums.__getitem__)
+            elif genes:
+                new_genes[idx] = genes[0]
+            else:
+                n_genes += 1
+                new_genes[idx] = f"{prefix}{n_genes}"
+                gene_nums[new_genes[idx]] = n_genes
 
-    dat['xrefs'] = xref_table
+    ## every cluster root is named above, so deferred links resolve:
+    for idx in deferred:
+        new_genes[idx] = new_genes[overlapper.find_root(parents, idx)]
 
+    for idx in fusions:
+        links = overlapper.cluster_roots(dat, idx)
+        genes = [] if idx in links else [new_genes[i] for i in links]
+        if first_named:
+            genes.sort(key=gene_nums.__getitem__)
+        new_genes[idx], n_genes = fusion_gene(genes, params, n_genes)
 
+    return n_genes
@@ -1,11 +1,9 @@
-def write_xref_records(dat, fh):
+## local:
+import compressor
+import storer
 
-    old_ids = dat['old_ids']
-    old_genes = dat['old_genes']
-    new_ids = dat['new_ids']
-    new_genes = dat['new_genes']
-    xrefs = dat['xrefs']
-    is_fusion = dat['is_fusion']
+
+def write_xref_header(fh):
 
     line = '\t'.join([
         'old_transcript', 
@@ -17,9 +15,22 @@ def write_xref_records(dat, fh):
     ])
     fh.write(f"{line}\n")
 
-    for idx, vals in enumerate(zip(old_ids, old_genes, new_ids, new_genes, is_fusion)):
 
-        old_id, old_gene, new_id, new_gene, is_fusion = vals
+def write_xref_rows(dat, fh, first=0):
+
+    old_ids = dat['old_ids']
+    old_genes = dat['old_genes']
+    new_ids = dat['new_ids']
+    new_genes = dat['new_genes']
+    xrefs = dat['xrefs']
+    is_fusion = dat['is_fusion']
+
+    for idx in range(first, len(old_ids)):
+
+        old_id = old_ids[idx]
+        old_gene = old_genes[idx]
+        new_id = new_ids[idx]
+        new_gene = new_genes[idx]
 
         if new_id is None:
             kept = 'False'
@@ -29,15 +40,29 @@ def write_xref_records(dat, fh):
         else:
             kept = 'True'
 
-        line = '\t'.join([old_id, old_gene, new_id, new_gene, str(is_fusion), kept])
+        line = '\t'.join([old_id, old_gene, new_id, new_gene, str(is_fusion[idx]), kept])
         fh.write(f"{line}\n")
 
 
+def write_xref_records(dat, fh):
+
+    write_xref_header(fh)
+    write_xref_rows(dat, fh)
+
+
+def xref_file(params):
+    return f"{params.output_prefix}.xrefs.tsv" + ('.gz' if params.compress_output else '')
+
+
+def gtf_file(params):
+    return f"{params.output_prefix}.gtf" + ('.gz' if params.compress_output else '')
+
+
 def write_xref_file(dat, params):
 
     try:
-        file_out = f"{params.output_prefix}.xrefs.tsv"
-        with open(file_out, 'w') as fh:
+        file_out = xref_file(params)
+        with compressor.open_output(file_out, 'w', params.compress_output) as fh:
             write_xref_records(dat, fh)
     except Exception as e:
         raise Exception(f"write_xref_file: for file_out {file_out}: {e}")
@@ -47,7 +72,7 @@ def write_exon_recs(transcript_idx, rec, dat, fh):
 
     rec[2] = 'exon'
     chrs = dat['chrs']
-    transcript = dat['transcripts'][transcript_idx]
+    transcript = storer.get_exons(dat, transcript_idx)
 
     for exon in transcript:
 
@@ -65,7 +90,7 @@ def write_exon_recs(transcript_idx, rec, dat, fh):
 
 def make_transcript_rec(transcript_idx, dat):
 
-    transcript = dat['transcripts'][transcript_idx]
+    transcript = storer.get_exons(dat, transcript_idx)
     new_gene_id = dat['new_genes'][transcript_idx]
     new_transcript_id = dat['new_ids'][transcript_idx]
 
@@ -111,32 +136,20 @@ def write_transcript_records(transcript_idx, dat, fh):
 
 def write_gtf_records(dat, fh):
 
-    tranges_chr = dat['tranges']
-    transcripts = dat['transcripts']
-    done = set()
-
-    if tranges_chr is None:
-        return 0, 0
-
+    order = dat['order']
     n_exons = 0
 
-    for trange_chr in tranges_chr:     ## in original chromosome order
-        for trange in trange_chr:      ## in (start, end) order
-            transcript_idx = trange[3]
-            if transcript_idx in done:
-                continue
-            n_exons += write_transcript_records(transcript_idx, dat, fh) 
-            done.add(transcript_idx)
+    for transcript_idx in order:       ## in (chromosome, start) order
+        n_exons += write_transcript_records(transcript_idx, dat, fh) 
 
-    ## n_transcripts = len(done):
-    return len(done), n_exons
+    return len(order), n_exons
 
 
 def write_gtf_file(dat, params):
 
     try:
-        file_out = f"{params.output_prefix}.gtf"
-        with open(file_out, 'w') as fh:
+        file_out = gtf_file(params)
+        with compressor.open_output(file_out, 'w', params.compress_output) as fh:
             n_transcripts, n_exons = write_gtf_records(dat, fh)
     except Exception as e:
         raise Exception(f"write_gtf_file: for file_out {file_out}: {e}")
@@ -181,9 +194,7 @@ def report_outputs(dat):
     done_genes = set()
     done_ids = set()
 
-    for idx, id1 in enumerate(ids):
-        if id1 is None:
-            continue
+    for idx in dat['order']:
         n_transcripts += 1
         done_ids.add(ids[idx])
         done_genes.add(genes[idx])
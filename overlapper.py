@@ -1,25 +1,16 @@
+import array
 import bisect
+import functools
+import heapq
+import indexer
+import itertools
 import math
+import multiprocessing
 import sys
+import storer
 import util
 
 
-def max_loc_length(chr_tranges):
-    '''
-    takes chr_tranges which is one element of tranges (tranges[i])
-    returns maximum segment/locus length in chr_tranges
-    '''
-
-    max_len = 0
-
-    for trange in chr_tranges:
-        len_i = trange[1] - trange[0]
-        if len_i > max_len:
-            max_len = len_i
-
-    return max_len
-
-
 def derive_starts(chr_tranges):
     
     starts = []     ## start of trange
@@ -66,142 +57,392 @@ def exons_overlap(exon1, exon2, p_exon_overlap):
         return False
 
 
-def same_gene(exons1, exons2, p_exon_overlap, p_exons_overlap):
+def overlap_getter(dat, p_exon_overlap, maxsize=65536):
+    '''
+    returns function f(id1, id2) equivalent to exons_overlap() of exons
+      id1 and id2 of the dat exon table, which keeps results for the
+      maxsize most recently compared pairs; isoforms at a busy locus
+      share exons, so the same pairs come up again and again
+    '''
+
+    @functools.lru_cache(maxsize=maxsize)
+    def overlap(id1, id2):
+        return exons_overlap(
+            storer.get_exon(dat, id1),
+            storer.get_exon(dat, id2),
+            p_exon_overlap
+        )
+
+    return overlap
+
 
-    n_exons_min = min(len(exons1), len(exons2))
+def sorted_exons(dat, ids):
+    '''
+    returns (exons, ids) for exon ids ids into the dat exon table, both
+      in (chr, strand, start, end) order of exons, as for same_gene()
+    '''
+
+    ## equal exons have equal ids, so ties in exon order are harmless:
+    pairs = sorted((storer.get_exon(dat, exon_id), exon_id) for exon_id in ids)
+
+    return [exon for exon, exon_id in pairs], [exon_id for exon, exon_id in pairs]
+
+
+def sorted_getter(dat, maxsize=16384):
+    '''
+    returns function f(idx) equivalent to sorted_exons() of transcript
+      idx, which keeps results for the maxsize most recently used
+      transcripts; returned lists are shared and must not be modified
+    '''
+
+    @functools.lru_cache(maxsize=maxsize)
+    def get_sorted(idx):
+        return sorted_exons(dat, storer.get_exon_ids(dat, idx))
+
+    return get_sorted
+
+
+def same_gene(sorted1, sorted2, overlap, p_exons_overlap):
+    '''
+    returns True if at least p_exons_overlap of the smaller exon count 
+      (and at least 1) of (exon1, exon2) pairs pass overlap(id1, id2),
+      as from overlap_getter(); sorted1 and sorted2 are (exons, ids) 
+      from sorted_exons(), which are swept in order, so only pairs whose
+      ranges intersect are compared
+    '''
+
+    exons1, ids1 = sorted1
+    exons2, ids2 = sorted2
+    n_exons2 = len(exons2)
+    n_exons_min = min(len(exons1), n_exons2)
     n_exons_overlap_min = math.ceil(p_exons_overlap * n_exons_min)
     n_exons_overlap = 0
-
-    for exon1 in exons1:
-        for exon2 in exons2:
-            if exons_overlap(exon1, exon2, p_exon_overlap):
+    idx2 = 0                 ## first exons2 member not wholly before exon1
+
+    for exon1, id1 in zip(exons1, ids1):
+
+        chr1, strand1, start1, end1 = exon1
+
+        while idx2 < n_exons2:
+            chr2, strand2, start2, end2 = exons2[idx2]
+            if chr2 > chr1 or (chr2 == chr1 and strand2 > strand1):
+                break
+            if chr2 == chr1 and strand2 == strand1 and end2 >= start1:
+                break
+            idx2 += 1
+
+        idx = idx2
+        while idx < n_exons2:
+            exon2 = exons2[idx]
+            if exon2[0] != chr1 or exon2[1] != strand1 or exon2[2] > end1:
+                break
+            if overlap(id1, ids2[idx]):
                 n_exons_overlap += 1
                 if n_exons_overlap >= n_exons_overlap_min:
                     return True
+            idx += 1
 
     return False
 
 
-def find_overlaps_nonfusion(dat, params):
+def find_root(parents, idx):
     '''
-    Populates dat['olaps'] w/ overlapping segments found in dat['tranges']
+    returns root of cluster containing idx; compresses path to root
+    '''
+
+    root = idx
+    while parents[root] != root:
+        root = parents[root]
+
+    while parents[idx] != root:
+        parents[idx], idx = root, parents[idx]
+
+    return root
+
+
+def union(parents, ranks, idx1, idx2):
+    '''
+    merges clusters containing idx1 and idx2 by rank; returns new root
+    '''
+
+    root1 = find_root(parents, idx1)
+    root2 = find_root(parents, idx2)
+
+    if root1 == root2:
+        return root1
+
+    if ranks[root1] < ranks[root2]:
+        root1, root2 = root2, root1
+
+    parents[root2] = root1
+    if ranks[root1] == ranks[root2]:
+        ranks[root1] += 1
+
+    return root1
+
+
+def cluster_roots(dat, idx):
+    '''
+    returns set of transcript indices of cluster roots linked to idx:
+      dat['olaps'][idx] for fusions and for non-fusions linked from more
+      than one cluster; otherwise {root of idx's cluster}
+    '''
+
+    roots = dat['olaps'].get(idx)
+    if roots is None:
+        roots = {find_root(dat['parents'], idx)}
+
+    return roots
+
+
+def same_cluster(dat, i1, i2):
+    '''
+    returns True if linking i1 to non-fusion i2 would not change anything
     '''
 
     olaps = dat['olaps']
+    parents = dat['parents']
+
+    if i1 in olaps or i2 in olaps:
+        return False
+
+    if parents[i2] == i2:
+        return False        ## i2 not yet linked
+
+    return find_root(parents, i1) == find_root(parents, i2)
+
+
+def link_clusters(dat, i1, i2):
+    '''
+    links i2 to the cluster(s) of earlier transcript i1: an unlinked 
+      non-fusion i2 joins the cluster of i1; fusions and non-fusions 
+      linked from several clusters collect roots in dat['olaps'][i2]
+    '''
+
+    olaps = dat['olaps']
+    parents = dat['parents']
+    roots1 = cluster_roots(dat, i1)
+
+    if dat['is_fusion'][i2] or i2 in olaps:
+        if i2 not in olaps:
+            olaps[i2] = set()
+        olaps[i2] |= roots1
+    elif parents[i2] == i2:          ## first link to i2
+        if i1 in olaps:
+            olaps[i2] = set()
+            olaps[i2] |= roots1
+        else:
+            union(parents, dat['ranks'], i1, i2)
+    else:
+        roots2 = cluster_roots(dat, i2)
+        if roots1 != roots2:
+            olaps[i2] = set()
+            olaps[i2] |= roots2
+            olaps[i2] |= roots1
+
+
+def query_strands(tranges_chr, indexes, start, stop, strands):
+    '''
+    returns tranges of tranges_chr on strands overlapping [start, stop],
+      in tranges order; indexes[strand] is built on first use
+    '''
+
+    hits = []
+
+    for strand in strands:
+        if indexes[strand] is None:
+            starts, stops, indices = derive_starts(tranges_chr[strand])
+            indexes[strand] = indexer.build_index(starts, stops)
+        strand_tranges = tranges_chr[strand]
+        for idx in indexer.query_index(indexes[strand], start, stop):
+            hits.append(strand_tranges[idx])
+
+    if len(strands) > 1:
+        hits.sort()
+
+    return hits
+
+
+def link_nonfusions(dat, params, idx_chr, strand=None, links=None):
+    '''
+    Links clusters of non-fusions in dat['tranges'][idx_chr] (only those
+      on strand, unless strand is None) to overlapping later segments on
+      the same strand; if links is a list, appends (trange, i1, i2) for
+      each link_clusters(dat, i1, i2) made, in order
+    '''
+
     is_fusion = dat['is_fusion']
-    transcripts = dat['transcripts']
-    old_ids = dat['old_ids']
-    p_exon_overlap = params.p_exon_overlap
+    get_sorted = sorted_getter(dat)
+    overlap = overlap_getter(dat, params.p_exon_overlap)
     p_exons_overlap = params.p_exons_overlap
+    tranges_chr = dat['tranges'][idx_chr]
+    strands = (0, 1) if strand is None else (strand,)
+
+    ## fusions on chromosome, and those w/ segments on both strands:
+    fusion_strands = {}
+    for tranges in tranges_chr:
+        for trange in tranges:
+            if is_fusion[trange[3]]:
+                fusion_strands.setdefault(trange[3], set()).add(trange[2])
+    both = {idx for idx, fstrands in fusion_strands.items() if len(fstrands) > 1}
+
+    ## transcript indices:
+    windows = {}                       ## strand: (tranges, starts, indices)
+    for i_strand in strands:
+        tranges = tranges_chr[i_strand]
+        if both:
+            ## exons of these on i_strand may lie under their other segment:
+            others = [trange for trange in tranges_chr[1 - i_strand] if trange[3] in both]
+            tranges = list(heapq.merge(tranges, others))
+        starts, stops, indices = derive_starts(tranges)
+        windows[i_strand] = (tranges, starts, indices)
+
+    ## (idx_trange, trange); strands only interact thru links to fusions,
+    ##   which are made in tranges order, interleaving strands:
+    if len(strands) > 1 and fusion_strands:
+        items = heapq.merge(
+            *[enumerate(windows[i_strand][0]) for i_strand in strands],
+            key=lambda item: item[1]
+        )
+    else:
+        items = itertools.chain(*[enumerate(windows[i_strand][0]) for i_strand in strands])
 
-    for idx_chr, chr_tranges in enumerate(dat['tranges']):
+    for idx_trange, trange in items:
 
-        print(f"{util.elapsed(params)}: processing {dat['chrs'][idx_chr]}")
+        i1 = trange[3]                 ## transcript index
+        if is_fusion[i1]:
+            continue
 
-        ## indices into dat['transcripts']:
-        starts, stops, indices = derive_starts(chr_tranges)
-        max_len = max_loc_length(chr_tranges)
+        tranges, starts, indices = windows[trange[2]]
+        sorted1 = get_sorted(i1)
+        start1 = trange[0]
+        stop1 = trange[1]
 
-        for idx_trange, trange in enumerate(chr_tranges):
+        ## only tranges starting w/i range1 are linked from it:
+        idx = bisect.bisect_left(starts, start1)
+        idx_end = bisect.bisect_right(starts, stop1)
 
-            i1 = trange[3]                 ## index into dat['transcripts']
-            if is_fusion[i1]:
-                continue
+        while idx < idx_end:
 
-            if i1 not in olaps:
-                olaps[i1] = {i1}
+            i2 = indices[idx]   ## transcript index
 
-            start1 = trange[0]
-            stop1 = trange[1]
+            if i1 == i2:
+                pass            ## self
+            elif idx_trange > idx and not is_fusion[i2]:
+                pass            ## only link later tranges to earlier, unless fusion
+            elif not is_fusion[i2] and same_cluster(dat, i1, i2):
+                pass            ## already linked
+            elif not same_gene(
+                sorted1,
+                get_sorted(i2),
+                overlap,
+                p_exons_overlap
+            ):
+                pass
+            else:
+                link_clusters(dat, i1, i2)
+                if links is not None:
+                    links.append((trange, i1, i2))
 
-            idx = bisect.bisect_left(starts, start1)
-            idx_end = bisect.bisect_right(starts, stop1 + max_len)
+            idx += 1
 
-            if idx_end >= len(starts):
-                idx_end = len(starts) - 1
 
-            while idx <= idx_end:
+def link_nonfusions_item(item):
+    '''
+    process pool worker; item is (idx_chr, strand); links are made in
+      the worker's copy of dat and returned for replay in the parent
+    '''
 
-                i2 = indices[idx]   ## index into dat['transcripts']
+    links = []
+    link_nonfusions(util.worker['dat'], util.worker['params'], *item, links)
 
-                if i1 == i2:
-                    pass            ## self
-                elif stop1 < starts[idx]:
-                    break           ## range1 ends before range2 begins
-                elif start1 > stops[idx]:
-                    pass            ## range1 begins after range2 ends
-                elif idx_trange > idx and not is_fusion[i2]:
-                    pass            ## only link later tranges to earlier, unless fusion
-                elif not same_gene(
-                    transcripts[i1],
-                    transcripts[i2],
-                    p_exon_overlap,
-                    p_exons_overlap
-                ):
-                    pass
-                else:
-                    if i2 not in olaps:
-                        olaps[i2] = set()
-                    olaps[i2] |= olaps[i1]
+    return links
 
-                idx += 1
 
+def find_overlaps_nonfusion(dat, params):
+    '''
+    Links clusters of overlapping segments found in dat['tranges'];
+      w/ params.threads > 1, links for each (chromosome, strand) are
+      found in a process pool, then replayed in serial order
+    '''
+
+    n_chrs = len(dat['tranges'])
+
+    if params.threads < 2:
+        for idx_chr in range(n_chrs):
+            print(f"{util.elapsed(params)}: processing {dat['chrs'][idx_chr]}")
+            link_nonfusions(dat, params, idx_chr)
+        return
+
+    ## non-fusions on different chromosomes or strands never link, so
+    ##   shards are independent:
+    items = [(idx_chr, strand) for idx_chr in range(n_chrs) for strand in (0, 1)]
 
-def find_overlaps_fusion(dat, params):
+    with multiprocessing.Pool(params.threads, util.init_worker, (dat, params)) as pool:
+        results = pool.imap(link_nonfusions_item, items)
+        for idx_chr in range(n_chrs):
+            links = heapq.merge(next(results), next(results), key=lambda link: link[0])
+            print(f"{util.elapsed(params)}: linking {dat['chrs'][idx_chr]}")
+            for trange, i1, i2 in links:
+                link_clusters(dat, i1, i2)
+
+
+def find_overlaps_fusion(dat, params, first=0, links=None):
     '''
     Populates dat['olaps'] w/ overlapping segments found in dat['tranges']
+      for fusions idx >= first: the cluster roots of non-fusions sharing
+      a gene w/ idx, or {idx} if none; if links is a list, appends 
+      (idx, i2) for each non-fusion i2 sharing a gene w/ idx, in order
+      found
     '''
 
     olaps = dat['olaps']
     is_fusion = dat['is_fusion']
-    transcripts = dat['transcripts']
-    p_exon_overlap = params.p_exon_overlap
+    get_sorted = sorted_getter(dat)
+    overlap = overlap_getter(dat, params.p_exon_overlap)
     p_exons_overlap = params.p_exons_overlap
 
-    for idx_chr, chr_tranges in enumerate(dat['tranges']):
+    for idx_chr, tranges_chr in enumerate(dat['tranges']):
 
         print(f"{util.elapsed(params)}: processing {dat['chrs'][idx_chr]}")
 
-        ## indices into dat['transcripts']:
-        starts, stops, indices = derive_starts(chr_tranges)
-        max_len = max_loc_length(chr_tranges)
-
-        for idx_trange, trange in enumerate(chr_tranges):
+        ## fusion segments, in tranges order:
+        fusion_tranges = sorted(
+            trange for tranges in tranges_chr for trange in tranges
+            if trange[3] >= first and is_fusion[trange[3]]
+        )
+        strands = {}                   ## fusion idx: [strand, ...]
+        for trange in fusion_tranges:
+            strands.setdefault(trange[3], []).append(trange[2])
+        indexes = [None, None]         ## by strand
 
-            i1 = trange[3]                 ## index into dat['transcripts']
-            if not is_fusion[i1]:
-                continue
+        for trange in fusion_tranges:
 
+            i1 = trange[3]                 ## transcript index
+            sorted1 = get_sorted(i1)
             start1 = trange[0]
             stop1 = trange[1]
-            left_end = max(start1 - max_len, 0)
-            idx = bisect.bisect_left(starts, left_end)
-            idx_end = bisect.bisect_right(starts, stop1)
-            if idx_end >= len(starts):
-                idx_end = len(starts) - 1
 
-            while idx <= idx_end:
+            ## tranges overlapping range1, in tranges order; non-fusions
+            ##   sharing a gene w/ i1 are on strands of its segments:
+            for trange2 in query_strands(tranges_chr, indexes, start1, stop1, strands[i1]):
 
-                i2 = indices[idx]     ## index into dat['transcripts']
+                i2 = trange2[3]       ## transcript index
                 if is_fusion[i2]:     ## covers if i1 == i2
                     pass
-                elif stop1 < starts[idx]:
-                    break             ## range1 ends before range2 begins
-                elif start1 > stops[idx]:
-                    pass              ## range1 begins after range2 ends
                 elif not same_gene(
-                    transcripts[i1],
-                    transcripts[i2],
-                    p_exon_overlap,
+                    sorted1,
+                    get_sorted(i2),
+                    overlap,
                     p_exons_overlap
                 ):
                     pass
                 else:
                     if i1 not in olaps:
                         olaps[i1] = set()
-                    olaps[i1] |= olaps[i2]
-
-                idx += 1
+                    olaps[i1] |= cluster_roots(dat, i2)
+                    if links is not None:
+                        links.append((i1, i2))
 
             if i1 not in olaps:
                 olaps[i1] = {i1}
@@ -210,9 +451,15 @@ def find_overlaps_fusion(dat, params):
 def find_overlaps(dat, params):
     '''
     entry point
-    Populates dat['olaps'] w/ overlapping segments found in dat['tranges']
+    Clusters overlapping segments found in dat['tranges'] into 
+      dat['parents'], dat['ranks'] and dat['olaps']
     '''
 
+    n_transcripts = storer.n_transcripts(dat)
+    dat['parents'] = array.array('q', range(n_transcripts))
+    dat['ranks'] = array.array('b', bytes(n_transcripts))
+    dat['olaps'] = {}
+
     print(f"{util.elapsed(params)}: finding overlaps between non-fusions")
     find_overlaps_nonfusion(dat, params)
 
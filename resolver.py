@@ -1,53 +1,85 @@
 ## system:
 import bisect
+import multiprocessing
 
 ## local:
+import storer
 import util
 
 
-def derive_starts(tranges, transcripts):
+def match_coords(transcript, params):
     '''
-    starts and indices hierarchies in register w/ tranges
+    returns [(coord1, tol1), (coord2, tol2)]: the first and last splice
+      junctions of transcript, or the start and end of a single exon 
+      transcript, w/ the tolerance for matching each
     '''
 
-    starts = []
-    indices = []
+    exon1 = transcript[0]
+    exon2 = transcript[-1]
 
-    for chr_trange in tranges:
-        chr_starts = []
-        chr_indices = []
-        for trange in chr_trange:
-            chr_starts.append(transcripts[trange[3]][0][2])
-            chr_indices.append(trange[3])
-        starts.append(chr_starts)
-        indices.append(chr_indices)
+    if len(transcript) > 1:
+        return [(exon1[3], params.tol_sj), (exon2[2], params.tol_sj)]
 
-    return starts, indices
+    if exon1[1]:                 ## '+' strand
+        return [(exon1[2], params.tol_tss), (exon1[3], params.tol_tts)]
+    else:                        ## '-' strand
+        return [(exon1[2], params.tol_tts), (exon1[3], params.tol_tss)]
 
 
-def match_starts(transcript, starts, indices, params):
+def index_transcripts(indices, params, get_exons):
     '''
-    returns list of indices of transcripts with starts
-      matching start of transcript
+    returns dict {(chr, strand, n_exons): (coords1, coords2, idxs), ...}
+      for transcripts in indices; coords1, coords2 and idxs are in
+      register, sorted by (coord1, idx), w/ match_coords() coordinates
+      of each transcript idx; transcripts that match w/i params.tol_*
+      share a key
     '''
 
-    idx_chr, strand, start, end = transcript[0]    ## first exon
+    groups = {}
 
-    ## '-': tts; '+': tss:
-    tol = (params.tol_tts, params.tol_tss)[strand]
+    for idx in indices:
+        transcript = get_exons(idx)
+        key = (transcript[0][0], transcript[0][1], len(transcript))
+        (coord1, tol1), (coord2, tol2) = match_coords(transcript, params)
+        if key not in groups:
+            groups[key] = []
+        groups[key].append((coord1, idx, coord2))
 
-    ## where in tranges starts might line up well enough:
-    starts_chr = starts[idx_chr]
-    idx = bisect.bisect_left(starts_chr, start - tol)
-    idx_end = bisect.bisect_right(starts_chr, start + tol)
-    if idx_end >= len(starts_chr):
-        idx_end = len(starts_chr) - 1
+    index = {}
 
-    ## transcript_maybe = dat.transcripts[maybe[i]]:
+    for key, group in groups.items():
+        group.sort()
+        index[key] = (
+            [item[0] for item in group],
+            [item[2] for item in group],
+            [item[1] for item in group]
+        )
+
+    return index
+
+
+def match_window(transcript, index, params):
+    '''
+    returns list of indices of transcripts in index w/ both match_coords()
+      coordinates w/i tolerance of those of transcript, so which might
+      match transcript w/i params.tol_*
+    '''
+
+    key = (transcript[0][0], transcript[0][1], len(transcript))
+    if key not in index:
+        return []
+
+    coords1, coords2, idxs = index[key]
+    (coord1, tol1), (coord2, tol2) = match_coords(transcript, params)
     maybe = []
-    while idx <= idx_end:
-        maybe.append(indices[idx_chr][idx])
-        idx += 1
+
+    i = bisect.bisect_left(coords1, coord1 - tol1)
+    i_end = bisect.bisect_right(coords1, coord1 + tol1)
+
+    while i < i_end:
+        if abs(coords2[i] - coord2) <= tol2:
+            maybe.append(idxs[i])
+        i += 1
 
     return maybe
 
@@ -104,41 +136,126 @@ def transcripts_match(transcript1, transcript2, tol_tss, tol_sj, tol_tts):
     return True
 
 
-def xref_transcripts(dat, params):
+def xref_transcripts_exact(dat):
     '''
-    populates dat['xrefs'] 
-      based on dat['tranges'] and dat['transcripts'];
-      params.tol_* determines stringency
+    populates dat['xrefs'] when params.tol_* are all 0, so only
+      transcripts w/ identical exon chains match; each transcript is
+      collapsed into the lowest indexed transcript w/ the same chain
     '''
 
-    print(f"  {util.elapsed(params)}: deriving starts")
-    starts, indices = derive_starts(dat['tranges'], dat['transcripts'])
+    xrefs = dat['xrefs']
+    kept = {}                    ## exon chain: idx
 
-    print(f"  {util.elapsed(params)}: matching transcripts")
-    for idx1, transcript1 in enumerate(dat['transcripts']):
+    for idx in range(storer.n_transcripts(dat)):
+        idx1 = kept.setdefault(storer.exon_chain(dat, idx), idx)
+        if idx1 != idx:
+            xrefs[idx] = idx1
 
-        if idx1 in dat['xrefs']:
+
+def xref_partition(dat, params, indices):
+    '''
+    returns xrefs {collapsed_idx: kept_idx, ...} among transcripts in 
+      ascending list indices, which must include every transcript that
+      might match any of them
+    '''
+
+    xrefs = {}
+    get_exons = storer.exon_getter(dat)
+    index = index_transcripts(indices, params, get_exons)
+
+    ## w/ tol_sj 0, internal exons of matching transcripts are identical,
+    ##   so their exon ids are compared first:
+    exact_sj = not params.tol_sj
+
+    for idx1 in indices:
+
+        if idx1 in xrefs:
             continue
 
-        maybe_list = match_starts(transcript1, starts, indices, params)
+        transcript1 = get_exons(idx1)
+        maybe_list = match_window(transcript1, index, params)
+        if exact_sj:
+            internal1 = storer.get_exon_ids(dat, idx1)[1:-1]
 
         for idx2 in maybe_list:
 
             if idx1 == idx2:             ## self
                 continue
 
-            if idx2 in dat['xrefs']:     ## already merged
+            if idx2 in xrefs:            ## already merged
+                continue
+
+            if exact_sj and storer.get_exon_ids(dat, idx2)[1:-1] != internal1:
                 continue
 
             if transcripts_match(
               transcript1, 
-              dat['transcripts'][idx2], 
+              get_exons(idx2), 
               params.tol_tss,
               params.tol_sj,
               params.tol_tts
             ):
-                dat['xrefs'][idx2] = idx1
-                dat['transcripts'][idx2] = None
+                xrefs[idx2] = idx1
+
+    return xrefs
+
+
+def xref_partition_item(indices):
+    '''
+    process pool worker; indices as for xref_partition()
+    '''
+
+    return xref_partition(util.worker['dat'], util.worker['params'], indices)
+
+
+def partition_transcripts(dat):
+    '''
+    returns lists of ascending transcript indices, one per (chr, strand)
+      of first exon; matching transcripts share chr and strand for 
+      every exon, so never fall in different lists
+    '''
+
+    offsets = dat['offsets']
+    chrs = dat['exon_chrs']
+    strands = dat['exon_strands']
+    exon_ids = dat['exon_ids']
+    partitions = {}
+
+    for idx in range(storer.n_transcripts(dat)):
+        exon_id = exon_ids[offsets[idx]]
+        key = (chrs[exon_id], strands[exon_id])
+        if key not in partitions:
+            partitions[key] = []
+        partitions[key].append(idx)
+
+    return [partitions[key] for key in sorted(partitions)]
+
+
+def xref_transcripts(dat, params):
+    '''
+    populates dat['xrefs'] based on dat exon store;
+      params.tol_* determines stringency; w/ params.threads > 1, each 
+      (chr, strand) partition is matched in a process pool
+    '''
+
+    if not (params.tol_tss or params.tol_sj or params.tol_tts):
+        print(f"  {util.elapsed(params)}: matching identical transcripts")
+        xref_transcripts_exact(dat)
+        return
+
+    if params.threads < 2:
+        print(f"  {util.elapsed(params)}: matching transcripts")
+        indices = list(range(storer.n_transcripts(dat)))
+        dat['xrefs'].update(xref_partition(dat, params, indices))
+        return
+
+    print(f"  {util.elapsed(params)}: partitioning transcripts")
+    partitions = partition_transcripts(dat)
+
+    print(f"  {util.elapsed(params)}: matching transcripts")
+    with multiprocessing.Pool(params.threads, util.init_worker, (dat, params)) as pool:
+        for xrefs in pool.imap_unordered(xref_partition_item, partitions):
+            dat['xrefs'].update(xrefs)
 
 
 def resolve_xrefs(dat):
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+"""
+interned exon store; each distinct exon (chr, strand, start, end) is
+  kept once in the columnar exon table, at position exon id of
+  dat['exon_chrs'], dat['exon_strands'], dat['exon_starts'] and
+  dat['exon_ends']; transcript idx is the sequence of exon ids at
+  positions dat['offsets'][idx] thru dat['offsets'][idx + 1] - 1 of
+  dat['exon_ids']; the index from exon to exon id, dat['exon2id'], is
+  only kept while exons are added, see exon_index() and drop_index()
+"""
+
+## system:
+import array
+import functools
+
+
+## (key, array typecode) for each column of the exon table, and of
+##   staged exons, as appended while parsing, in exon field order:
+COLUMNS = (
+    ('exon_chrs', 'i'),
+    ('exon_strands', 'b'),
+    ('exon_starts', 'q'),
+    ('exon_ends', 'q'),
+)
+
+## dat keys of the store:
+STORE_KEYS = tuple(key for key, typecode in COLUMNS) + ('exon_ids', 'offsets')
+
+
+def new_columns():
+    '''
+    returns dict of empty staged exon columns
+    '''
+
+    return {key: array.array(typecode) for key, typecode in COLUMNS}
+
+
+def new_store():
+    '''
+    returns dict of empty store, keyed like dat
+    '''
+
+    return {
+        **new_columns(),
+        'exon_ids': array.array('i'),
+        'offsets': array.array('q', [0]),
+    }
+
+
+def exon_index(dat):
+    '''
+    returns dat['exon2id'] = {(chr, strand, start, end): exon id, ...},
+      building it from the exon table if dropped
+    '''
+
+    if 'exon2id' not in dat:
+        dat['exon2id'] = {exon: exon_id for exon_id, exon in enumerate(iter_exons(dat))}
+
+    return dat['exon2id']
+
+
+def drop_index(dat):
+    '''
+    drops dat['exon2id'] once no more exons are added, so it is neither
+      kept in memory nor saved w/ dat
+    '''
+
+    dat.pop('exon2id', None)
+
+
+def intern_exon(dat, exon):
+    '''
+    returns exon id of exon (chr, strand, start, end), adding it to the
+      exon table if new
+    '''
+
+    exon2id = exon_index(dat)
+    exon_id = exon2id.get(exon)
+    if exon_id is None:
+        exon_id = len(dat['exon_starts'])
+        for (key, typecode), value in zip(COLUMNS, exon):
+            dat[key].append(value)
+        exon2id[exon] = exon_id
+
+    return exon_id
+
+
+def iter_exons(dat):
+    '''
+    returns iterator over exons (chr, strand, start, end) of the exon
+      table, in exon id order
+    '''
+
+    return zip(*[dat[key] for key, typecode in COLUMNS])
+
+
+def get_exon(dat, exon_id):
+    '''
+    returns exon (chr, strand, start, end) w/ exon_id
+    '''
+
+    return (
+        dat['exon_chrs'][exon_id],
+        dat['exon_strands'][exon_id],
+        dat['exon_starts'][exon_id],
+        dat['exon_ends'][exon_id],
+    )
+
+
+def n_transcripts(dat):
+    return len(dat['offsets']) - 1
+
+
+def get_exon_ids(dat, idx):
+    '''
+    returns array of exon ids of transcript idx, in transcript order
+    '''
+
+    return dat['exon_ids'][dat['offsets'][idx]:dat['offsets'][idx + 1]]
+
+
+def get_exons(dat, idx):
+    '''
+    returns list of exons [(chr, strand, start, end), ...] for
+      transcript idx
+    '''
+
+    chrs = dat['exon_chrs']
+    strands = dat['exon_strands']
+    starts = dat['exon_starts']
+    ends = dat['exon_ends']
+
+    return [
+        (chrs[exon_id], strands[exon_id], starts[exon_id], ends[exon_id])
+        for exon_id in get_exon_ids(dat, idx)
+    ]
+
+
+def exon_chain(dat, idx):
+    '''
+    returns bytes encoding all exons of transcript idx; equal for two
+      transcripts iff their exons are identical and in the same order
+    '''
+
+    return get_exon_ids(dat, idx).tobytes()
+
+
+def exon_getter(dat, maxsize=16384):
+    '''
+    returns function f(idx) equivalent to get_exons(dat, idx), which 
+      keeps exons of the maxsize most recently used transcripts; for
+      read-only stages that revisit transcripts at the same locus;
+      returned lists are shared and must not be modified
+    '''
+
+    return functools.lru_cache(maxsize=maxsize)(
+        functools.partial(get_exons, dat)
+    )
+
+
+def set_exons(dat, idx, exons):
+    '''
+    overwrites exons of transcript idx w/ same number of exons
+    '''
+
+    i0 = dat['offsets'][idx]
+    i1 = dat['offsets'][idx + 1]
+
+    if len(exons) != i1 - i0:
+        raise Exception(f"set_exons: exon count mismatch for transcript {idx}")
+
+    dat['exon_ids'][i0:i1] = array.array('i', [intern_exon(dat, exon) for exon in exons])
+
+
+def append_exons(dat, staged):
+    '''
+    Args:
+      staged: exon columns, as from new_columns(), in file order, plus
+        staged['rnas'], transcript indices in register w/ the columns, 
+        covering all transcripts registered since the last call
+    Returns: None
+    Side-effect: appends ids of exons to dat['exon_ids'] grouped by 
+      transcript, keeping the order of exons w/i each transcript, and
+      interning new exons; extends dat['offsets']
+    '''
+
+    rnas = staged['rnas']
+    offsets = dat['offsets']
+    idx_first = len(offsets) - 1
+    counts = [0] * (len(dat['old_ids']) - idx_first)
+
+    for idx in rnas:
+        counts[idx - idx_first] += 1
+
+    ## stable, and linear when exons already grouped by transcript:
+    order = sorted(range(len(rnas)), key=rnas.__getitem__)
+
+    exons = zip(*[staged[key] for key, typecode in COLUMNS])
+    exon_ids = [intern_exon(dat, exon) for exon in exons]
+    dat['exon_ids'].extend(array.array('i', [exon_ids[i] for i in order]))
+
+    for count in counts:
+        offsets.append(offsets[-1] + count)
+
+
+def extend_exons(dat, other, chr_map):
+    '''
+    Args:
+      other: dict w/ store, as in dat
+      chr_map: list mapping chromosome indices of other to those of dat
+    Returns: None
+    Side-effect: appends transcripts of other after those in dat,
+      interning exons of other
+    '''
+
+    offsets = dat['offsets']
+    base = offsets[-1]
+    id_map = [
+        intern_exon(dat, (chr_map[exon[0]],) + exon[1:]) for exon in iter_exons(other)
+    ]
+
+    dat['exon_ids'].extend(array.array('i', [id_map[i] for i in other['exon_ids']]))
+    offsets.extend(array.array('q', [base + i for i in other['offsets'][1:]]))
+
+
+def select_exons(dat, indices):
+    '''
+    returns dict of store, laid out as in dat, holding only transcripts
+      in indices, in that order, and only their exons
+    '''
+
+    selected = new_store()
+    offsets = selected['offsets']
+
+    for idx in indices:
+        exons = get_exons(dat, idx)
+        selected['exon_ids'].extend(
+            array.array('i', [intern_exon(selected, exon) for exon in exons])
+        )
+        offsets.append(offsets[-1] + len(exons))
+
+    drop_index(selected)
+
+    return selected
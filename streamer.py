@@ -0,0 +1,598 @@
+#!/usr/bin/env python
+
+"""
+streaming merge of coordinate-sorted gtf files; non-fusion transcripts
+  are k-way merged by (chromosome, start) and processed one locus
+  window at a time, so memory depends on the largest window instead of
+  total input size; fusions are held back and merged in a final pass
+  against the non-fusion transcripts already written
+"""
+
+## system:
+import array
+import heapq
+import re
+
+## local:
+import compressor
+import indexer
+import inputter
+import namer
+import outputter
+import overlapper
+import resolver
+import storer
+import util
+
+
+###############################################################################
+## sorted input stuff:
+
+## transcript_id value in an exon line, as bytes, w/ any quotes; only
+##   whole attribute names match, as for inputter.scan_attribute():
+TRANSCRIPT_ID = re.compile(rb'[\t ;]transcript_id +("[^"]*"|[^ ;\r\n]*)')
+
+def transcript_span(exons):
+    '''
+    returns (chr, start, end) spanning exons, or None if exons are on
+      more than one chromosome
+    '''
+
+    chr_id = exons[0][0]
+    start = exons[0][2]
+    end = exons[0][3]
+
+    for exon in exons:
+        if exon[0] != chr_id:
+            return None
+        if exon[2] < start:
+            start = exon[2]
+        if exon[3] > end:
+            end = exon[3]
+
+    return chr_id, start, end
+
+
+def check_order(order, transcript):
+    '''
+    raises Exception unless single chromosome transcripts arrive grouped
+      by chromosome and by ascending start w/i chromosome; order tracks
+      transcripts seen so far in the file
+    '''
+
+    span = transcript_span(transcript[3])
+    if span is None:
+        return
+
+    chr_id, start, end = span
+
+    if chr_id != order['chr']:
+        if chr_id in order['chrs']:
+            raise Exception(
+                f"chromosome {chr_id} not contiguous at transcript {transcript[1]}"
+            )
+        order['chrs'].add(chr_id)
+        order['chr'] = chr_id
+    elif start < order['start']:
+        raise Exception(f"transcript {transcript[1]} not sorted by start")
+
+    order['start'] = start
+
+
+def read_transcripts(label, gtf):
+    '''
+    generator yielding (ordinal, transcript_id, gene_id, exons) for each
+      transcript in gtf, in file order; exons are [(chr_id, strand,
+      start, end), ...] in listed order; exon lines of each transcript
+      must be adjacent, and transcripts sorted as for check_order()
+    '''
+
+    transcript = None
+    n_transcripts = 0
+    order = {'chrs': set(), 'chr': None, 'start': 0}
+
+    try:
+        for toks in inputter.read_exon_toks(gtf):
+
+            start, end, strand, transcript_id, gene_id = inputter.parse_toks(toks, label)
+
+            if transcript is None or transcript[1] != transcript_id:
+                if transcript is not None:
+                    check_order(order, transcript)
+                    yield transcript
+                transcript = (n_transcripts, transcript_id, gene_id, [])
+                n_transcripts += 1
+
+            transcript[3].append((toks[0].decode(), strand, start, end))
+
+        if transcript is not None:
+            check_order(order, transcript)
+            yield transcript
+
+    except Exception as e:
+        raise Exception(f"read_transcripts: for {label}; {gtf}: {e}")
+
+
+def scan_chromosomes(label, gtf):
+    '''
+    returns list of chromosomes of single chromosome transcripts in gtf,
+      in file order; raises Exception unless each is contiguous, as for
+      check_order(); only the chromosome and transcript_id of exon lines
+      are read, so this costs about a third of parsing gtf; other fields
+      are checked later, by read_transcripts()
+    '''
+
+    seq = []
+    transcript = None            ## [transcript_id, {chr_id, ...}]
+
+    def add_transcript():
+        if transcript is None or len(transcript[1]) > 1:
+            return
+        chr_id = next(iter(transcript[1]))
+        if seq and seq[-1] == chr_id:
+            return
+        if chr_id in seq:
+            transcript_id = transcript[0].strip(b'"').decode()
+            raise Exception(
+                f"chromosome {chr_id.decode()} not contiguous at transcript {transcript_id}"
+            )
+        seq.append(chr_id)
+
+    try:
+        with compressor.map_input(gtf) as fh:
+            for line in iter(fh.readline, b''):
+                if inputter.EXON_TAG not in line or line.startswith(b'#'):
+                    continue
+                toks = line.split(b'\t', 3)
+                if toks[2] != b'exon':
+                    continue
+                match = TRANSCRIPT_ID.search(line)
+                if match is None:
+                    raise Exception(f"no transcript_id found on line: {line.decode()}")
+                if transcript is None or transcript[0] != match.group(1):
+                    add_transcript()
+                    transcript = [match.group(1), {toks[0]}]
+                else:
+                    transcript[1].add(toks[0])
+        add_transcript()
+    except Exception as e:
+        raise Exception(f"scan_chromosomes: for {label}; {gtf}: {e}")
+
+    return [chr_id.decode() for chr_id in seq]
+
+
+def chromosome_order(id2gtf, params):
+    '''
+    returns list of chromosomes consistent w/ the order of chromosomes
+      in every gtf, preferring order of first appearance in id2gtf
+      order; raises Exception if gtf files order chromosomes differently;
+      each gtf is scanned once more for this, see scan_chromosomes()
+    '''
+
+    seqs = []
+    rank = {}                    ## chr_id: order of first appearance
+
+    for label, gtf in id2gtf.items():
+        print(f"{util.elapsed(params)}: scanning {label}: {gtf}")
+        seq = scan_chromosomes(label, gtf)
+        for chr_id in seq:
+            rank.setdefault(chr_id, len(rank))
+        seqs.append(seq)
+
+    ## topological sort of chromosomes by (chr1 before chr2) in any gtf:
+    chr_ids = list(rank)
+    n_before = {chr_id: 0 for chr_id in chr_ids}
+    after = {chr_id: set() for chr_id in chr_ids}
+
+    for seq in seqs:
+        for chr1, chr2 in zip(seq, seq[1:]):
+            if chr2 not in after[chr1]:
+                after[chr1].add(chr2)
+                n_before[chr2] += 1
+
+    ready = [rank[chr_id] for chr_id in chr_ids if not n_before[chr_id]]
+    heapq.heapify(ready)
+    chrs = []
+
+    while ready:
+        chr1 = chr_ids[heapq.heappop(ready)]
+        chrs.append(chr1)
+        for chr2 in after[chr1]:
+            n_before[chr2] -= 1
+            if not n_before[chr2]:
+                heapq.heappush(ready, rank[chr2])
+
+    if len(chrs) < len(chr_ids):
+        raise Exception("chromosome_order: gtf files order chromosomes differently")
+
+    return chrs
+
+
+def order_exons(exons, params):
+    '''
+    applies params.sort_exons or params.rev_neg_exons to exons in place
+    '''
+
+    if params.sort_exons:
+        exons.sort(key=lambda exon: (exon[2], exon[3]))
+    elif params.rev_neg_exons and exons[0][1] == 0:
+        exons.reverse()
+
+
+def sample_stream(i_gtf, label, gtf, state, params):
+    '''
+    generator yielding (chr_id, start, end, key, transcript_id, gene_id,
+      exons) for non-fusion transcripts in gtf, in file order; key is
+      (i_gtf, ordinal), which orders transcripts as in batch mode;
+      fusions go to state['fusions'] as (key, transcript_id, gene_id,
+      exons) instead
+    '''
+
+    for ordinal, transcript_id, gene_id, exons in read_transcripts(label, gtf):
+
+        order_exons(exons, params)
+        key = (i_gtf, ordinal)
+
+        if inputter.transcript_is_fusion(exons, params):
+            state['fusions'].append((key, transcript_id, gene_id, exons))
+            continue
+
+        chr_id, start, end = transcript_span(exons)
+        yield chr_id, start, end, key, transcript_id, gene_id, exons
+
+
+def chr_transcripts(streams, heads, i_gtf, chr_id):
+    '''
+    generator yielding transcripts of streams[i_gtf] on chr_id, starting
+      w/ heads[i_gtf]; leaves first transcript of next chromosome in
+      heads[i_gtf]
+    '''
+
+    while heads[i_gtf] is not None and heads[i_gtf][0] == chr_id:
+        yield heads[i_gtf]
+        heads[i_gtf] = next(streams[i_gtf], None)
+
+
+def locus_windows(transcripts, params):
+    '''
+    generator yielding lists of transcripts from start sorted transcripts
+      on one chromosome; a window closes when the next transcript starts
+      past every end in the window by more than any params.tol_*, so no
+      transcript in a later window can overlap or match one in it
+    '''
+
+    tol = max(params.tol_tss, params.tol_sj, params.tol_tts)
+    window = []
+    end_max = 0
+
+    for transcript in transcripts:
+        if window and transcript[1] > end_max + tol:
+            yield window
+            window = []
+        if not window or transcript[2] > end_max:
+            end_max = transcript[2]
+        window.append(transcript)
+
+    if window:
+        yield window
+
+
+###############################################################################
+## window merging stuff:
+
+def new_dat(chrs):
+    '''
+    returns empty dat, as in mergegtfs.py, for chromosomes chrs
+    '''
+
+    return {
+        'chrs': chrs,
+        'chr2idx': {chr_id: idx for idx, chr_id in enumerate(chrs)},
+        **storer.new_store(),
+        'is_fusion': [],
+        'old_ids': [],
+        'old_genes': [],
+        'new_ids': [],
+        'new_genes': [],
+        'tranges': [],
+        'order': array.array('q'),
+        'xrefs': {},
+        'parents': array.array('q'),
+        'ranks': array.array('b'),
+        'olaps': {}
+    }
+
+
+def add_transcripts(dat, transcripts, is_fusion):
+    '''
+    appends transcripts [(transcript_id, gene_id, exons), ...] to dat,
+      registering new chromosomes
+    '''
+
+    staged = storer.new_columns()
+    staged['rnas'] = array.array('q')
+    chrs = dat['chrs']
+    chr2idx = dat['chr2idx']
+
+    for transcript_id, gene_id, exons in transcripts:
+
+        dat['old_ids'].append(transcript_id)
+        dat['old_genes'].append(gene_id)
+        dat['is_fusion'].append(is_fusion)
+        idx = len(dat['old_ids']) - 1
+
+        for chr_id, strand, start, end in exons:
+            chr_idx = chr2idx.get(chr_id)
+            if chr_idx is None:
+                chrs.append(chr_id)
+                chr_idx = len(chrs) - 1
+                chr2idx[chr_id] = chr_idx
+            staged['rnas'].append(idx)
+            staged['exon_chrs'].append(chr_idx)
+            staged['exon_strands'].append(strand)
+            staged['exon_starts'].append(start)
+            staged['exon_ends'].append(end)
+
+    storer.append_exons(dat, staged)
+
+
+def merge_window(window, state, params, fh_gtf, fh_xref):
+    '''
+    merges, clusters and names non-fusion transcripts in window from
+      locus_windows(), as mergegtfs.py does for a whole dataset, then
+      writes them to fh_gtf and fh_xref
+    '''
+
+    chr_id = window[0][0]
+
+    ## transcript indices in batch mode order:
+    window.sort(key=lambda transcript: transcript[3])
+    dat = new_dat([chr_id])
+    add_transcripts(dat, [transcript[4:] for transcript in window], False)
+    n_transcripts = storer.n_transcripts(dat)
+
+    if len(set(dat['old_ids'])) != n_transcripts:
+        raise Exception(
+            f"merge_window: transcript_id repeated near {chr_id}:{window[0][1]}; "
+            "exon lines of each transcript must be adjacent"
+        )
+
+    if not (params.tol_tss or params.tol_sj or params.tol_tts):
+        resolver.xref_transcripts_exact(dat)
+    else:
+        indices = list(range(n_transcripts))
+        dat['xrefs'].update(resolver.xref_partition(dat, params, indices))
+    resolver.resolve_xrefs(dat)
+
+    tranges_chr = [[], []]             ## by strand
+    for idx, transcript in enumerate(window):
+        if idx not in dat['xrefs']:
+            strand = transcript[6][0][1]
+            tranges_chr[strand].append([transcript[1], transcript[2], strand, idx])
+    for strand_tranges in tranges_chr:
+        strand_tranges.sort()
+    dat['tranges'] = [tranges_chr]
+    inputter.order_transcripts(dat)
+
+    dat['parents'] = array.array('q', range(n_transcripts))
+    dat['ranks'] = array.array('b', bytes(n_transcripts))
+    overlapper.link_nonfusions(dat, params, 0)
+
+    state['n_genes'] = namer.name_genes(dat, params, state['n_genes'], first_named=True)
+    namer.name_transcripts(dat)
+
+    ## fusions sharing a gene w/ a transcript linked to several genes
+    ##   are linked to all of them, as in batch mode:
+    for idx, roots in dat['olaps'].items():
+        state['olap_genes'][dat['new_ids'][idx]] = [dat['new_genes'][root] for root in roots]
+
+    for idx in dat['order']:
+        outputter.write_transcript_records(idx, dat, fh_gtf)
+    outputter.write_xref_rows(dat, fh_xref)
+
+    state['n_transcripts'] += n_transcripts
+    state['n_kept'] += len(dat['order'])
+    if n_transcripts > state['n_window_max']:
+        state['n_window_max'] = n_transcripts
+
+
+###############################################################################
+## fusion stuff:
+
+def link_fusions(dat, params, olap_genes):
+    '''
+    reads non-fusion transcripts back from output gtf; returns
+      (links, counts): links = {idx: {gene: None, ...}, ...} lists genes
+      of non-fusions sharing a gene w/ fusion idx of dat, or for those
+      in olap_genes = {transcript_id: [gene, ...]}, all their genes;
+      counts = {gene: number of non-fusion transcripts, ...}, in order
+      of first output, which is the order genes were named in
+    '''
+
+    gtf = outputter.gtf_file(params)
+    p_exons_overlap = params.p_exons_overlap
+    chr2idx = dat['chr2idx']
+    get_sorted = overlapper.sorted_getter(dat)
+    overlap = overlapper.overlap_getter(dat, params.p_exon_overlap)
+    indices = []                       ## [[(index, idxs) by strand], ...]
+    links = {}
+    counts = {}
+
+    for tranges_chr in dat['tranges']:
+        indices.append([])
+        for strand_tranges in tranges_chr:
+            starts, stops, idxs = overlapper.derive_starts(strand_tranges)
+            indices[-1].append((indexer.build_index(starts, stops), idxs))
+
+    ## read w/o label, so ids are f":{id}":
+    for ordinal, transcript_id, gene_id, exons in read_transcripts(None, gtf):
+
+        transcript_id = transcript_id[1:]
+        gene = gene_id[1:]
+        counts[gene] = counts.get(gene, 0) + 1
+
+        chr_id, start, end = transcript_span(exons)
+        index, idxs = indices[chr2idx[chr_id]][exons[0][1]]
+        sorted2 = None
+
+        for i in indexer.query_index(index, start, end):
+            idx = idxs[i]
+            if sorted2 is None:
+                ## interned in dat's exon table, unreferenced by transcripts:
+                ids2 = [storer.intern_exon(dat, (chr2idx[exon[0]],) + exon[1:]) for exon in exons]
+                sorted2 = overlapper.sorted_exons(dat, ids2)
+            if overlapper.same_gene(
+                get_sorted(idx),
+                sorted2,
+                overlap,
+                p_exons_overlap
+            ):
+                if idx not in links:
+                    links[idx] = {}
+                for gene2 in olap_genes.get(transcript_id, (gene,)):
+                    links[idx][gene2] = None
+
+    return links, counts
+
+
+def merge_fusions(state, params):
+    '''
+    merges fusions held back by sample_stream(); names them after genes
+      of overlapping non-fusions, as namer.name_genes() does w/ 
+      first_named, and appends them to output files
+    '''
+
+    fusions = sorted(state['fusions'], key=lambda fusion: fusion[0])
+    state['fusions'] = []
+    dat = new_dat(list(state['chrs']))
+    add_transcripts(dat, [fusion[1:] for fusion in fusions], True)
+    del fusions
+
+    print(f"{util.elapsed(params)}: cross-referencing fusions")
+    resolver.xref_transcripts(dat, params)
+    resolver.resolve_xrefs(dat)
+
+    print(f"{util.elapsed(params)}: populating fusion tranges")
+    inputter.populate_tranges(dat, params)
+
+    print(f"{util.elapsed(params)}: finding fusion overlaps")
+    links, counts = link_fusions(dat, params, state['olap_genes'])
+    gene_nums = {gene: n for n, gene in enumerate(counts)}
+
+    print(f"{util.elapsed(params)}: naming fusions")
+    n_transcripts = storer.n_transcripts(dat)
+    new_genes = dat['new_genes'] = [None] * n_transcripts
+    new_ids = dat['new_ids'] = [None] * n_transcripts
+    n_genes = state['n_genes']
+    kept = []
+
+    for idx in dat['order']:            ## in (chromosome, start) order
+        genes = sorted(links.get(idx, {}), key=gene_nums.__getitem__)
+        gene, n_genes = namer.fusion_gene(genes, params, n_genes)
+        if len(genes) > 1:
+            state['fusion_genes'].add(gene)
+        counts[gene] = counts.get(gene, 0) + 1
+        new_genes[idx] = gene
+        new_ids[idx] = f"{gene}.{counts[gene]}"
+        kept.append(idx)
+
+    state['n_genes'] = n_genes
+    state['n_transcripts'] += n_transcripts
+    state['n_fusions'] += n_transcripts
+    state['n_kept'] += len(kept)
+    state['n_kept_fusions'] += len(kept)
+
+    print(f"{util.elapsed(params)}: writing fusions")
+    try:
+        file_out = outputter.gtf_file(params)
+        with compressor.open_output(file_out, 'a', params.compress_output) as fh:
+            for idx in kept:
+                outputter.write_transcript_records(idx, dat, fh)
+        file_out = outputter.xref_file(params)
+        with compressor.open_output(file_out, 'a', params.compress_output) as fh:
+            outputter.write_xref_rows(dat, fh)
+    except Exception as e:
+        raise Exception(f"merge_fusions: for file_out {file_out}: {e}")
+
+
+###############################################################################
+## entrypoints:
+
+def stream_gtf_files(id2gtf, params):
+    '''
+    entry point
+    Args:
+      id2gtf: dict {label: gtf} from ingest_gtf_list_file(); each gtf
+        sorted as for read_transcripts()
+      params: run-time configuration parameters
+    Returns: state dict for report()
+    Side-effect: writes output gtf and xref files
+    '''
+
+    state = {
+        'chrs': [],
+        'fusions': [],
+        'fusion_genes': set(),
+        'olap_genes': {},
+        'n_genes': 0,
+        'n_transcripts': 0,
+        'n_fusions': 0,
+        'n_kept': 0,
+        'n_kept_fusions': 0,
+        'n_window_max': 0,
+    }
+
+    state['chrs'] = chromosome_order(id2gtf, params)
+
+    labels = list(id2gtf)
+    streams = [
+        sample_stream(i_gtf, label, gtf, state, params)
+        for i_gtf, (label, gtf) in enumerate(id2gtf.items())
+    ]
+    heads = [next(stream, None) for stream in streams]
+
+    gtf_out = outputter.gtf_file(params)
+    xref_out = outputter.xref_file(params)
+    compress = params.compress_output
+
+    with compressor.open_output(gtf_out, 'w', compress) as fh_gtf, \
+      compressor.open_output(xref_out, 'w', compress) as fh_xref:
+
+        outputter.write_xref_header(fh_xref)
+
+        for chr_id in state['chrs']:
+
+            print(f"{util.elapsed(params)}: streaming {chr_id}")
+            transcripts = heapq.merge(
+                *[chr_transcripts(streams, heads, i, chr_id) for i in range(len(streams))],
+                key=lambda transcript: transcript[1]
+            )
+
+            for window in locus_windows(transcripts, params):
+                merge_window(window, state, params, fh_gtf, fh_xref)
+
+    for label, head in zip(labels, heads):
+        if head is not None:
+            raise Exception(
+                f"stream_gtf_files: for {label}: chromosome {head[0]} out of order"
+            )
+
+    if state['fusions']:
+        merge_fusions(state, params)
+
+    return state
+
+
+def report(state):
+
+    n_genes = state['n_genes'] + len(state['fusion_genes'])
+
+    print(
+        f"number of chromosomes: {len(state['chrs'])}\n"
+        f"number of input transcripts: {state['n_transcripts']}\n"
+        f"number of input fusion transcripts: {state['n_fusions']}\n"
+        f"number of output transcripts: {state['n_kept']}\n"
+        f"number of output fusion transcripts: {state['n_kept_fusions']}\n"
+        f"number of unique output gene ids: {n_genes}\n"
+        f"largest locus window: {state['n_window_max']} transcripts"
+    )
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+"""
+parameter sweeps; gtf files are ingested once, then transcripts are
+  cross-referenced once per combination of tol_* values, and clustered,
+  named and written once per combination of all swept values
+"""
+
+## system:
+import copy
+import itertools
+import multiprocessing
+
+## local:
+import inputter
+import intypes
+import namer
+import outputter
+import overlapper
+import resolver
+import util
+
+
+## parameters that can be swept, w/ their types:
+SWEEP_PARAMS = {
+    'tol_sj': intypes.non_negative_int,
+    'tol_tss': intypes.non_negative_int,
+    'tol_tts': intypes.non_negative_int,
+    'p_exon_overlap': intypes.float_proportion,
+    'p_exons_overlap': intypes.float_proportion,
+}
+
+
+def ingest_grid_file(grid_file):
+    '''
+    entry point
+    input: grid_file: a text file w/ one parameter name from
+      SWEEP_PARAMS, a tab and comma separated values per line
+    output: dict of parameters and values {name0: [val0, ...], ...}
+    '''
+
+    grid = {}
+    try:
+        with open(grid_file, 'r') as fh:
+            for line in fh:
+                line = line.strip()
+                if not len(line):
+                    continue
+                if line.startswith('#'):
+                    continue
+                toks = line.split('\t')
+                if len(toks) != 2:
+                    raise Exception(f"len(toks) != 2 ({len(toks)}) on line: {line}")
+                if toks[0] not in SWEEP_PARAMS:
+                    raise Exception(f"parameter '{toks[0]}' can not be swept.")
+                if toks[0] in grid:
+                    raise Exception(f"parameter '{toks[0]}' listed more than once.")
+                grid[toks[0]] = [SWEEP_PARAMS[toks[0]](val) for val in toks[1].split(',')]
+    except Exception as e:
+        raise Exception(f"ingest_grid_file: for grid_file {grid_file}: {e}")
+
+    return grid
+
+
+def expand_grid(grid, params):
+    '''
+    returns list of settings, one per combination of values in grid,
+      w/ later parameters in grid varying fastest; each setting is a
+      dict {name: val, ...} w/ every parameter in SWEEP_PARAMS, taking
+      values of parameters not in grid from params
+    '''
+
+    settings = []
+
+    for vals in itertools.product(*grid.values()):
+        setting = {name: getattr(params, name) for name in SWEEP_PARAMS}
+        setting.update(zip(grid, vals))
+        settings.append(setting)
+
+    return settings
+
+
+def setting_params(params, setting, i_setting, threads):
+    '''
+    returns copy of params w/ values of setting, threads, and output
+      prefix f"{params.output_prefix}.{i_setting}"
+    '''
+
+    params_i = copy.copy(params)
+
+    for name, val in setting.items():
+        setattr(params_i, name, val)
+
+    params_i.output_prefix = f"{params.output_prefix}.{i_setting}"
+    params_i.threads = threads
+
+    return params_i
+
+
+def sweep_tols(dat, params, items, threads):
+    '''
+    Args:
+      items: [(i_setting, setting), ...], all w/ the same tol_* values
+    Returns: summary rows [[i_setting, output_prefix, val, ...,
+      n_transcripts, n_genes], ...]
+    Side-effect: cross-references dat once, then clusters, names and
+      writes outputs for each setting
+    '''
+
+    rows = []
+
+    params_i = setting_params(params, items[0][1], items[0][0], threads)
+    print(
+        f"{util.elapsed(params)}: cross-referencing w/ tol_sj {params_i.tol_sj}, "
+        f"tol_tss {params_i.tol_tss}, tol_tts {params_i.tol_tts}"
+    )
+
+    ## tranges of all transcripts are filtered in a copy:
+    tranges = dat['tranges']
+    dat['tranges'] = [[strand_tranges[:] for strand_tranges in tranges_chr] for tranges_chr in tranges]
+    dat['xrefs'] = {}
+    resolver.xref_transcripts(dat, params_i)
+    resolver.resolve_xrefs(dat)
+    inputter.filter_tranges(dat)
+
+    for i_setting, setting in items:
+
+        params_i = setting_params(params, setting, i_setting, threads)
+        print(f"{util.elapsed(params)}: merging setting {i_setting}: {setting}")
+
+        overlapper.find_overlaps(dat, params_i)
+        namer.name_genes(dat, params_i)
+        namer.name_transcripts(dat)
+
+        outputter.write_xref_file(dat, params_i)
+        outputter.write_gtf_file(dat, params_i)
+
+        n_genes = len({dat['new_genes'][idx] for idx in dat['order']})
+
+        rows.append(
+            [i_setting, params_i.output_prefix] +
+            [setting[name] for name in SWEEP_PARAMS] +
+            [len(dat['order']), n_genes]
+        )
+
+    dat['tranges'] = tranges
+
+    return rows
+
+
+def sweep_tols_item(items):
+    '''
+    process pool worker; items as for sweep_tols()
+    '''
+
+    return sweep_tols(util.worker['dat'], util.worker['params'], items, 1)
+
+
+def write_summary_file(rows, params):
+
+    try:
+        file_out = f"{params.output_prefix}.sweep.tsv"
+        with open(file_out, 'w') as fh:
+            header = ['setting', 'output_prefix', *SWEEP_PARAMS, 'transcripts', 'genes']
+            fh.write('\t'.join(header) + '\n')
+            for row in rows:
+                line = '\t'.join(str(val) for val in row)
+                fh.write(f"{line}\n")
+    except Exception as e:
+        raise Exception(f"write_summary_file: for file_out {file_out}: {e}")
+
+
+def sweep(dat, params):
+    '''
+    entry point
+    Args:
+      dat: data structure w/ fusions identified and tranges populated
+      params: run-time configuration parameters; params.sweep is path
+        to grid file for ingest_grid_file()
+    Returns: None
+    Side-effect: writes gtf and xref files for setting i to prefix
+      f"{params.output_prefix}.{i}", and summary of all settings to
+      f"{params.output_prefix}.sweep.tsv"; w/ params.threads > 1,
+      settings w/ different tol_* values are merged in a process pool
+    '''
+
+    grid = ingest_grid_file(params.sweep)
+    settings = expand_grid(grid, params)
+
+    ## settings sharing tol_* values share cross-referencing:
+    groups = {}
+    for i_setting, setting in enumerate(settings, 1):
+        key = (setting['tol_sj'], setting['tol_tss'], setting['tol_tts'])
+        if key not in groups:
+            groups[key] = []
+        groups[key].append((i_setting, setting))
+
+    print(f"{util.elapsed(params)}: sweeping {len(settings)} settings")
+    rows = []
+
+    if params.threads < 2 or len(groups) < 2:
+        for items in groups.values():
+            rows.extend(sweep_tols(dat, params, items, params.threads))
+    else:
+        n_procs = min(params.threads, len(groups))
+        with multiprocessing.Pool(n_procs, util.init_worker, (dat, params)) as pool:
+            for group_rows in pool.imap(sweep_tols_item, groups.values()):
+                rows.extend(group_rows)
+
+    rows.sort()
+    write_summary_file(rows, params)
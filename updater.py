@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+
+"""
+incremental merging; a merge saves its exemplars (transcripts kept in
+  the output gtf), their new ids and the gene counter next to its
+  outputs, and --update adds new samples to that state, matching and
+  clustering only the new transcripts; ids already assigned never change
+"""
+
+## system:
+import array
+import os
+import pickle
+
+## local:
+import compressor
+import inputter
+import namer
+import outputter
+import overlapper
+import resolver
+import storer
+import util
+
+
+## parameters that must be the same for a merge and its updates:
+STATE_PARAMS = (
+    'tol_sj',
+    'tol_tss',
+    'tol_tts',
+    'p_exon_overlap',
+    'p_exons_overlap',
+    'max_intron_length',
+    'sort_exons',
+    'rev_neg_exons',
+    'gene_prefix',
+    'compress_output',
+)
+
+
+def state_file(params):
+    return f"{params.output_prefix}.state.pkl"
+
+
+def save_state(dat, params, labels, n_genes):
+    '''
+    entry point
+    Args:
+      dat: data structure after naming
+      labels: sample labels merged into dat so far
+      n_genes: number of genes named f"{params.gene_prefix}{n}"
+    Returns: None
+    Side-effect: writes exemplars of dat to state_file(params)
+    '''
+
+    new_ids = dat['new_ids']
+    kept = [idx for idx in range(storer.n_transcripts(dat)) if new_ids[idx] is not None]
+
+    state = {
+        'params': {name: getattr(params, name) for name in STATE_PARAMS},
+        'labels': list(labels),
+        'chrs': dat['chrs'],
+        **storer.select_exons(dat, kept),
+        'is_fusion': [dat['is_fusion'][idx] for idx in kept],
+        'old_ids': [dat['old_ids'][idx] for idx in kept],
+        'old_genes': [dat['old_genes'][idx] for idx in kept],
+        'new_ids': [new_ids[idx] for idx in kept],
+        'new_genes': [dat['new_genes'][idx] for idx in kept],
+        'n_genes': n_genes,
+    }
+
+    file_out = state_file(params)
+    try:
+        with open(f"{file_out}.tmp", 'wb') as fh:
+            pickle.dump(state, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{file_out}.tmp", file_out)
+    except Exception as e:
+        raise Exception(f"save_state: for file_out {file_out}: {e}")
+
+
+def load_state(id2gtf, params):
+    '''
+    returns (dat, labels, n_genes) from state_file(params); exemplars
+      are the first transcripts of dat; raises Exception if parameters
+      differ from the saved ones or labels in id2gtf were merged before
+    '''
+
+    file_in = state_file(params)
+    if not os.path.exists(file_in):
+        raise Exception(
+            f"load_state: no state file {file_in}; --update needs outputs of a "
+            "merge w/ the same --output_prefix in the default mode, as merges "
+            "w/ --stream or --sweep save no state"
+        )
+
+    try:
+        with open(file_in, 'rb') as fh:
+            state = pickle.load(fh)
+    except Exception as e:
+        raise Exception(f"load_state: for file_in {file_in}: {e}")
+
+    for name, value in state['params'].items():
+        if getattr(params, name) != value:
+            raise Exception(
+                f"load_state: --{name} is {getattr(params, name)}, "
+                f"but {value} in {file_in}"
+            )
+
+    for label in id2gtf:
+        if label in state['labels']:
+            raise Exception(f"load_state: label '{label}' already merged in {file_in}")
+
+    dat = {
+        'chrs': state['chrs'],
+        'chr2idx': {chr_id: idx for idx, chr_id in enumerate(state['chrs'])},
+        **{key: state[key] for key in storer.STORE_KEYS},
+        'is_fusion': state['is_fusion'],
+        'old_ids': state['old_ids'],
+        'old_genes': state['old_genes'],
+        'new_ids': state['new_ids'],
+        'new_genes': state['new_genes'],
+        'tranges': [],
+        'order': array.array('q'),
+        'xrefs': {},
+        'parents': array.array('q'),
+        'ranks': array.array('b'),
+        'olaps': {}
+    }
+
+    return dat, state['labels'], state['n_genes']
+
+
+###############################################################################
+## update stuff:
+
+def xref_new(dat, params, n_fixed):
+    '''
+    populates dat['xrefs'] for transcripts idx >= n_fixed; as
+      resolver.xref_transcripts() would, w/ exemplars idx < n_fixed
+      never collapsed: each new transcript matching an exemplar is
+      collapsed into the lowest such exemplar, and the rest are matched
+      among themselves
+    '''
+
+    xrefs = dat['xrefs']
+    n_transcripts = storer.n_transcripts(dat)
+    rest = []
+
+    ## exemplars have distinct exon chains, so none is collapsed:
+    if not (params.tol_tss or params.tol_sj or params.tol_tts):
+        resolver.xref_transcripts_exact(dat)
+        return
+
+    get_exons = storer.exon_getter(dat)
+    index = resolver.index_transcripts(range(n_fixed), params, get_exons)
+
+    for idx2 in range(n_fixed, n_transcripts):
+
+        transcript2 = get_exons(idx2)
+        idx1 = None
+
+        for idx in resolver.match_window(transcript2, index, params):
+            if idx1 is not None and idx > idx1:
+                continue
+            if resolver.transcripts_match(
+              get_exons(idx),
+              transcript2,
+              params.tol_tss,
+              params.tol_sj,
+              params.tol_tts
+            ):
+                idx1 = idx
+
+        if idx1 is None:
+            rest.append(idx2)
+        else:
+            xrefs[idx2] = idx1
+
+    xrefs.update(resolver.xref_partition(dat, params, rest))
+    resolver.resolve_xrefs(dat)
+
+
+def link_new(dat, params, n_fixed):
+    '''
+    returns {root_idx: {gene: None, ...}, ...}; clusters new kept
+      non-fusions (idx >= n_fixed) that share a gene into dat['parents']
+      and maps the root of each cluster to the genes of exemplar
+      non-fusions sharing a gene w/ any member, in tranges order
+    '''
+
+    is_fusion = dat['is_fusion']
+    new_genes = dat['new_genes']
+    parents = dat['parents']
+    ranks = dat['ranks']
+    get_sorted = overlapper.sorted_getter(dat)
+    overlap = overlapper.overlap_getter(dat, params.p_exon_overlap)
+    p_exons_overlap = params.p_exons_overlap
+    links = {}                   ## new idx: {gene: None, ...}
+
+    for idx_chr, tranges_chr in enumerate(dat['tranges']):
+
+        indexes = [None, None]   ## by strand
+
+        for trange in inputter.chr_tranges(dat, idx_chr):
+
+            i1 = trange[3]
+            if i1 < n_fixed or is_fusion[i1]:
+                continue
+
+            sorted1 = get_sorted(i1)
+            hits = overlapper.query_strands(tranges_chr, indexes, trange[0], trange[1], (trange[2],))
+
+            for trange2 in hits:
+
+                i2 = trange2[3]
+                if i1 == i2 or is_fusion[i2]:
+                    continue
+                if i2 >= n_fixed and overlapper.find_root(parents, i1) == overlapper.find_root(parents, i2):
+                    continue
+                if not overlapper.same_gene(sorted1, get_sorted(i2), overlap, p_exons_overlap):
+                    continue
+
+                if i2 < n_fixed:
+                    if i1 not in links:
+                        links[i1] = {}
+                    links[i1][new_genes[i2]] = None
+                else:
+                    overlapper.union(parents, ranks, i1, i2)
+
+    root_links = {}
+
+    for i1, genes in links.items():
+        root = overlapper.find_root(parents, i1)
+        if root not in root_links:
+            root_links[root] = {}
+        root_links[root].update(genes)
+
+    return root_links
+
+
+def name_new(dat, params, n_fixed, n_genes):
+    '''
+    names new kept transcripts idx >= n_fixed; a cluster of new
+      non-fusions takes the gene of the first exemplar it shares a gene
+      with, or else a new gene; fusions are named as by
+      namer.fusion_gene(); returns updated n_genes
+    '''
+
+    n_transcripts = storer.n_transcripts(dat)
+    is_fusion = dat['is_fusion']
+    xrefs = dat['xrefs']
+    new_genes = dat['new_genes']
+    new_ids = dat['new_ids']
+    new_genes.extend([None] * (n_transcripts - n_fixed))
+    new_ids.extend([None] * (n_transcripts - n_fixed))
+
+    dat['parents'] = array.array('q', range(n_transcripts))
+    dat['ranks'] = array.array('b', bytes(n_transcripts))
+    root_links = link_new(dat, params, n_fixed)
+
+    ## genes of clusters, named in tranges order:
+    root_genes = {}
+    for idx in dat['order']:
+        if idx < n_fixed or is_fusion[idx]:
+            continue
+        root = overlapper.find_root(dat['parents'], idx)
+        if root not in root_genes:
+            genes = list(root_links.get(root, {}))
+            if genes:
+                root_genes[root] = genes[0]
+            else:
+                n_genes += 1
+                root_genes[root] = f"{params.gene_prefix}{n_genes}"
+        new_genes[idx] = root_genes[root]
+
+    ## genes of fusions, in order of the non-fusions found sharing a 
+    ##   gene w/ them; exemplars are not clustered, so several share one:
+    links = []
+    overlapper.find_overlaps_fusion(dat, params, n_fixed, links)
+    fusion_genes = {}                  ## idx: {gene: None, ...}
+    for idx, i2 in links:
+        fusion_genes.setdefault(idx, {})[new_genes[i2]] = None
+
+    for idx in dat['order']:
+        if idx < n_fixed or not is_fusion[idx]:
+            continue
+        genes = list(fusion_genes.get(idx, {}))
+        new_genes[idx], n_genes = namer.fusion_gene(genes, params, n_genes)
+
+    ## transcript numbers continue from exemplars of each gene:
+    counts = {}
+    for gene in new_genes[:n_fixed]:
+        counts[gene] = counts.get(gene, 0) + 1
+
+    for idx in dat['order']:
+        if idx < n_fixed:
+            continue
+        gene = new_genes[idx]
+        counts[gene] = counts.get(gene, 0) + 1
+        new_ids[idx] = f"{gene}.{counts[gene]}"
+
+    return n_genes
+
+
+def write_outputs(dat, params, n_fixed):
+    '''
+    rewrites output gtf w/ all exemplars, and appends xrefs of new
+      transcripts to the existing xref file; files are written under
+      temporary names, then renamed
+    '''
+
+    gtf_out = outputter.gtf_file(params)
+    xref_out = outputter.xref_file(params)
+    compress = params.compress_output
+
+    try:
+        file_out = gtf_out
+        with compressor.open_output(f"{gtf_out}.tmp", 'w', compress) as fh:
+            n_transcripts, n_exons = outputter.write_gtf_records(dat, fh)
+
+        file_out = xref_out
+        with compressor.open_input(xref_out) as fh_in, \
+          compressor.open_output(f"{xref_out}.tmp", 'w', compress) as fh:
+            for line in fh_in:
+                fh.write(line)
+            outputter.write_xref_rows(dat, fh, n_fixed)
+
+        os.replace(f"{gtf_out}.tmp", gtf_out)
+        os.replace(f"{xref_out}.tmp", xref_out)
+    except Exception as e:
+        raise Exception(f"write_outputs: for file_out {file_out}: {e}")
+
+    return n_transcripts, n_exons
+
+
+###############################################################################
+## entrypoints:
+
+def update_gtf_files(id2gtf, params):
+    '''
+    entry point
+    Args:
+      id2gtf: dict {label: gtf} of samples not yet merged
+      params: run-time configuration parameters
+    Returns: None
+    Side-effect: adds samples to outputs and state of an earlier merge
+      w/ the same params.output_prefix
+    '''
+
+    print(f"{util.elapsed(params)}: loading merge state")
+    dat, labels, n_genes = load_state(id2gtf, params)
+    n_fixed = storer.n_transcripts(dat)
+
+    inputter.ingest_gtf_files(id2gtf, dat, params)
+
+    if params.sort_exons:
+        print(f"{util.elapsed(params)}: sorting exons")
+        inputter.sort_exons(dat, n_fixed)
+    elif params.rev_neg_exons:
+        print(f"{util.elapsed(params)}: reversing negative strand exon order")
+        inputter.rev_neg_exons(dat, n_fixed)
+
+    ## no exons added past ingestion:
+    storer.drop_index(dat)
+
+    print(f"{util.elapsed(params)}: identifying fusions")
+    inputter.identify_fusions(dat, params)
+
+    print(f"{util.elapsed(params)}: cross-referencing new transcripts")
+    xref_new(dat, params, n_fixed)
+
+    print(f"{util.elapsed(params)}: populating tranges")
+    inputter.populate_tranges(dat, params)
+
+    print(f"{util.elapsed(params)}: naming new transcripts")
+    n_genes_new = name_new(dat, params, n_fixed, n_genes)
+
+    print(f"{util.elapsed(params)}: writing outputs")
+    write_outputs(dat, params, n_fixed)
+    save_state(dat, params, labels + list(id2gtf), n_genes_new)
+
+    n_transcripts = storer.n_transcripts(dat)
+    n_new = sum(1 for idx in range(n_fixed, n_transcripts) if idx not in dat['xrefs'])
+
+    print(
+        f"number of exemplars before update: {n_fixed}\n"
+        f"number of new input transcripts: {n_transcripts - n_fixed}\n"
+        f"number of new exemplars: {n_new}\n"
+        f"number of new gene ids: {n_genes_new - n_genes}"
+    )
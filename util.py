@@ -2,6 +2,19 @@
 
 import time
 
+## per-process copies of dat and params for process pool workers:
+worker = {}
+
+
+def init_worker(dat, params):
+    '''
+    process pool initializer; shares dat and params w/ worker functions
+    '''
+
+    worker['dat'] = dat
+    worker['params'] = params
+
+
 def elapsed(params, places=3):
     return round(time.time() - params.time_start, places)
 